@@ -1,36 +1,43 @@
 import asyncio
 from pyrogram import filters
-from bot.config import app, OWNER_ID, active_downloads, MAX_CONCURRENT_DOWNLOADS
-from bot.database import set_user_role, ban_user, update_setting, get_setting, get_all_users, get_user_count
+from bot.config import app, OWNER_ID
+from bot.scheduler import scheduler
+from bot.database import cancel_user_jobs, set_user_role, ban_user, update_setting, get_setting, get_all_users, get_user_count, user_cache, counter_buffer
 
 @app.on_message(filters.command("stats") & filters.private)
 async def stats(client, message):
     if str(message.from_user.id) != str(OWNER_ID): return
     
     total_users = await get_user_count()
+    queue = scheduler.stats()
+    cache = user_cache.stats()
+    counters = counter_buffer.stats()
     
     await message.reply(
         f"📊 **Bot Statistics**\n\n"
         f"👥 Total Users: `{total_users}`\n"
-        f"⚡ Active Downloads: `{len(active_downloads)}/{MAX_CONCURRENT_DOWNLOADS}`"
+        f"⚡ Active Downloads: `{queue['running']}/{queue['slots']}`\n"
+        f"⏳ Queued: `{queue['queued']}` ({queue['users']} users with jobs)\n"
+        f"🗂 User Cache: `{cache['size']}/{cache['max_entries']}`, hit rate `{cache['hit_rate']:.0%}` "
+        f"({cache['hits']} hits, {cache['misses']} misses, {cache['evictions']} evictions)\n"
+        f"🧮 Counter Buffer: `{counters['pending_updates']}` pending for {counters['pending_users']} users, "
+        f"{counters['flushed_updates']} changes written in {counters['flushes']} commits"
     )
 
 @app.on_message(filters.command("killall") & filters.private)
 async def kill_all_processes(client, message):
     if str(message.from_user.id) != str(OWNER_ID): return
     
-    from bot.config import cancel_flags
+    from bot.task_registry import running_tasks
     
-    if not active_downloads:
+    if not running_tasks.tasks:
         await message.reply("⚠️ No active downloads to kill.")
         return
         
-    count = len(active_downloads)
-    for uid in list(active_downloads):
-        cancel_flags.add(uid)
+    count = running_tasks.cancel_all()
+    await cancel_user_jobs()
     
-    active_downloads.clear()
-    await message.reply(f"✅ Killed all `{count}` active processes and sent cancellation signals.")
+    await message.reply(f"✅ Killed all `{count}` active processes.")
 
 @app.on_message(filters.command("setrole") & filters.private)
 async def setrole(client, message):
@@ -4,7 +4,7 @@ import html
 from typing import Optional, Dict, Any, List
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from bot.config import RICHADS_PUBLISHER_ID, RICHADS_WIDGET_ID, AD_DAILY_LIMIT, AD_FOR_PREMIUM
-from bot.database import get_user, increment_ad_count, get_ad_count_today
+from bot.user_context import UserContext
 
 logger = logging.getLogger(__name__)
 
@@ -66,21 +66,23 @@ class RichAdsManager:
         except Exception as e:
             logger.debug(f"RichAds: Impression error: {e}")
 
-    async def show_ad(self, client, user_id, lang_code="en"):
-        """Fetch and show RichAd to user"""
+    async def show_ad(self, client, user_id, lang_code="en", ctx=None):
+        """Fetch and show RichAd to user. With a request's UserContext the ad count is written back with the rest of it."""
         if not self.is_enabled():
             return
 
-        user = await get_user(user_id)
-        if not user:
+        own_ctx = ctx is None
+        if own_ctx:
+            ctx = await UserContext.load(user_id)
+        if not ctx.exists:
             return
         
         # Check premium settings
-        if user.get("role") in ["premium", "admin", "owner"] and not self.for_premium:
+        if ctx.is_premium and not self.for_premium:
             return
         
         # Check daily limit
-        ad_count = await get_ad_count_today(user_id)
+        ad_count = ctx.ads_today
         if ad_count >= AD_DAILY_LIMIT:
             logger.info(f"RichAds: Daily limit reached for user {user_id}")
             return
@@ -149,7 +151,9 @@ class RichAdsManager:
             if notification_url:
                 await self.notify_impression(notification_url)
             
-            await increment_ad_count(user_id)
+            ctx.add_ad()
+            if own_ctx:
+                await ctx.save()
             
         except Exception as e:
             # Silently handle errors showing ads to prevent log clutter and disruptions
@@ -161,5 +165,5 @@ async def fetch_ad(user_id, lang_code="en"):
     ads = await richads_manager.fetch_ad(lang_code, str(user_id))
     return ads[0] if ads else None
 
-async def show_ad(client, user_id, lang_code="en"):
-    await richads_manager.show_ad(client, user_id, lang_code)
+async def show_ad(client, user_id, lang_code="en", ctx=None):
+    await richads_manager.show_ad(client, user_id, lang_code, ctx=ctx)
@@ -0,0 +1,181 @@
+import os
+import time
+import json
+import asyncio
+import logging
+from bot.config import get_smart_download_workers, get_smart_upload_workers, get_smart_chunk_size
+
+logger = logging.getLogger(__name__)
+
+# Bounds the tuner never leaves
+MAX_DOWNLOAD_WORKERS = int(os.environ.get("MAX_DOWNLOAD_WORKERS", 8))
+MAX_UPLOAD_WORKERS = int(os.environ.get("MAX_UPLOAD_WORKERS", 12))
+CHUNK_SIZES = (128 * 1024, 256 * 1024, 512 * 1024)
+# Telegram rejects uploads of more parts than this (FILE_PARTS_INVALID)
+MAX_UPLOAD_PARTS = 4000
+# Files smaller than this keep the static settings from bot/config.py
+TUNE_MIN_SIZE = 10 * 1024 * 1024
+# Weight of the newest sample in the moving averages
+EWMA_ALPHA = 0.3
+# Per-connection speed assumed until a DC has been measured (bytes/s)
+DEFAULT_WORKER_SPEED = 1024 * 1024
+# Settings row the tuned values are persisted in
+SETTINGS_KEY = "transfer_tuning"
+SAVE_INTERVAL = 60
+
+class TransferStats:
+    """Counters for one transfer, filled in by the part workers in bot/transfer.py"""
+    __slots__ = ("bytes", "errors", "flood_waits", "start")
+
+    def __init__(self):
+        self.bytes = 0
+        self.errors = 0
+        self.flood_waits = 0
+        self.start = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+class TransferTuner:
+    """
+    Feedback controller for transfer parallelism and part size, per DC and direction.
+
+    After every large transfer the measured throughput and error/FloodWait counts are fed
+    back through record(). FloodWaits halve the worker count, errors drop it by one and
+    shrink the part size, and a clean transfer that matched the best speed seen so far
+    probes one more worker. The best known settings per DC are saved to the settings table,
+    so they survive restarts. Worker counts are also capped by the measured AES-IGE speed,
+    since every transferred byte has to be encrypted or decrypted on our CPU.
+    """
+    def __init__(self):
+        self.state = {}
+        self.crypto_speed = None
+        self.last_save = 0
+        self.dirty = False
+
+    def _key(self, dc_id, direction):
+        return f"{direction}:{dc_id}"
+
+    def _limit(self, direction):
+        return MAX_DOWNLOAD_WORKERS if direction == "download" else MAX_UPLOAD_WORKERS
+
+    def cpu_worker_cap(self, dc_id, direction):
+        """How many connections the CPU can keep fed at the speed one connection gets on this DC"""
+        if not self.crypto_speed:
+            return self._limit(direction)
+        state = self.state.get(self._key(dc_id, direction))
+        worker_speed = state["worker_speed"] if state else DEFAULT_WORKER_SPEED
+        # Leave some headroom for the rest of the bot
+        return max(1, int(self.crypto_speed * 0.8 / max(worker_speed, 1)))
+
+    def settings(self, dc_id, direction, file_size):
+        """Returns (workers, chunk_size) to use for a transfer of `file_size` bytes"""
+        if direction == "download":
+            workers = get_smart_download_workers(file_size)
+        else:
+            workers = get_smart_upload_workers(file_size)
+        chunk_size = get_smart_chunk_size(file_size)
+
+        state = self.state.get(self._key(dc_id, direction))
+        if state and file_size >= TUNE_MIN_SIZE:
+            workers = state["workers"]
+            chunk_size = state["chunk_size"]
+
+        if direction == "upload":
+            # A part size tuned down after errors must still fit the file in MAX_UPLOAD_PARTS
+            min_chunk = -(-file_size // MAX_UPLOAD_PARTS)
+            chunk_size = max(chunk_size, next((size for size in CHUNK_SIZES if size >= min_chunk), CHUNK_SIZES[-1]))
+
+        workers = max(1, min(workers, self._limit(direction), self.cpu_worker_cap(dc_id, direction)))
+        return workers, chunk_size
+
+    def record(self, dc_id, direction, workers, chunk_size, stats: TransferStats):
+        """Feeds the outcome of a finished (or failed) transfer back into the controller"""
+        if stats.bytes < TUNE_MIN_SIZE and not (stats.errors or stats.flood_waits):
+            return
+
+        key = self._key(dc_id, direction)
+        speed = stats.bytes / max(stats.elapsed, 0.001)
+        state = self.state.get(key)
+        if not state:
+            state = self.state[key] = {
+                "workers": workers,
+                "chunk_size": chunk_size,
+                "speed": speed,
+                "worker_speed": speed / workers,
+                "best_workers": workers,
+                "best_speed": speed,
+                "errors": 0.0,
+                "flood_waits": 0.0
+            }
+
+        state["speed"] += EWMA_ALPHA * (speed - state["speed"])
+        state["worker_speed"] += EWMA_ALPHA * (speed / workers - state["worker_speed"])
+        state["errors"] += EWMA_ALPHA * (min(stats.errors, 1) - state["errors"])
+        state["flood_waits"] += EWMA_ALPHA * (min(stats.flood_waits, 1) - state["flood_waits"])
+
+        limit = min(self._limit(direction), self.cpu_worker_cap(dc_id, direction))
+        chunk_index = CHUNK_SIZES.index(state["chunk_size"]) if state["chunk_size"] in CHUNK_SIZES else len(CHUNK_SIZES) - 1
+
+        if stats.flood_waits:
+            state["workers"] = max(1, workers // 2)
+            state["best_speed"] *= 0.5
+        elif stats.errors:
+            state["workers"] = max(1, workers - 1)
+            state["chunk_size"] = CHUNK_SIZES[max(0, chunk_index - 1)]
+        elif speed >= state["best_speed"] * 0.95:
+            state["best_workers"] = workers
+            state["best_speed"] = max(speed, state["best_speed"])
+            state["workers"] = min(limit, workers + 1)
+            state["chunk_size"] = CHUNK_SIZES[min(len(CHUNK_SIZES) - 1, chunk_index + 1)]
+        else:
+            # More connections didn't pay off, go back to the best count seen
+            state["workers"] = min(limit, state["best_workers"])
+            # Slowly forget old records so a once-fast DC can be re-probed
+            state["best_speed"] *= 0.98
+
+        logger.info(
+            f"Autotune {key}: {speed / 1024 / 1024:.2f} MB/s with {workers} workers x {chunk_size // 1024} KB "
+            f"(errors={stats.errors}, flood_waits={stats.flood_waits}) -> next {state['workers']} x {state['chunk_size'] // 1024} KB"
+        )
+        self.dirty = True
+        if time.time() - self.last_save >= SAVE_INTERVAL:
+            asyncio.ensure_future(self.save())
+
+    async def load(self):
+        from bot.database import get_setting
+        setting = await get_setting(SETTINGS_KEY)
+        if setting and setting.get("json_value"):
+            try:
+                self.state = json.loads(setting["json_value"])
+                logger.info(f"Autotune: loaded tuned settings for {len(self.state)} DC directions")
+            except ValueError as e:
+                logger.warning(f"Autotune: ignoring unreadable saved settings: {e}")
+
+    async def save(self):
+        if not self.dirty:
+            return
+        from bot.database import update_setting
+        self.dirty = False
+        self.last_save = time.time()
+        await update_setting(SETTINGS_KEY, None, json.dumps(self.state))
+
+def benchmark_crypto(duration=0.2):
+    """Measures AES-256-IGE throughput (bytes/s) of the crypto backend MTProto will use"""
+    # Small blocks, so the pure-python fallback still finishes quickly
+    data = os.urandom(64 * 1024)
+    key = os.urandom(32)
+    iv = os.urandom(32)
+    # pyrogram's aes module picks TgCrypto when installed and falls back to pure python otherwise
+    from pyrogram.crypto import aes
+    encrypt = aes.ige256_encrypt
+
+    done = 0
+    start = time.perf_counter()
+    while not done or time.perf_counter() - start < duration:
+        encrypt(data, key, iv)
+        done += len(data)
+    return done / (time.perf_counter() - start)
+
+tuner = TransferTuner()
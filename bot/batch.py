@@ -0,0 +1,97 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Telegram rate-limits message edits, so the batch message is redrawn at most this often
+RENDER_INTERVAL = 3
+# Lines of each running item's status shown in the batch message
+ITEM_LINES = 2
+
+class ItemStatus:
+    """
+    Stands in for the status message of one batch item: run_download (and progress_bar)
+    edit it like a Message, and the text ends up as a line of the batch's progress message.
+    """
+    def __init__(self, batch, msg_id):
+        self.batch = batch
+        self.msg_id = msg_id
+        # progress_bar keys its throttling state by message id
+        self.id = ("batch", batch.message.id, msg_id)
+        self.text = ""
+        self.deleted = False
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        self.batch.dirty = True
+        return self
+
+    async def delete(self):
+        self.deleted = True
+        self.batch.dirty = True
+
+    @property
+    def failed(self):
+        # Successful items delete their status or end on a summary; anything else is an error or a rejection
+        return not self.deleted and self.text.startswith(("❌", "⛔", "⚠️"))
+
+class BatchProgress:
+    """One progress message for a whole /batch: done/failed counters plus the items running"""
+    def __init__(self, message, total, skipped=0):
+        self.message = message
+        self.total = total
+        self.skipped = skipped
+        self.running = {}
+        self.done = 0
+        self.failures = []
+        self.dirty = True
+        self.last_text = None
+        self.started = time.time()
+
+    def item(self, msg_id):
+        status = self.running[msg_id] = ItemStatus(self, msg_id)
+        return status
+
+    def finish(self, status):
+        self.running.pop(status.msg_id, None)
+        if status.failed:
+            self.failures.append((status.msg_id, status.text.splitlines()[0]))
+        else:
+            self.done += 1
+        self.dirty = True
+
+    def render(self, final=False):
+        finished = self.done + len(self.failures)
+        if final:
+            lines = [f"✅ Batch finished in {int(time.time() - self.started)}s: {self.done}/{self.total} delivered"]
+        else:
+            lines = [f"📦 Batch download: {finished}/{self.total} finished"]
+        if self.skipped:
+            lines.append(f"⏭ {self.skipped} empty or duplicate album message(s) skipped")
+        if self.failures:
+            lines.append(f"❌ {len(self.failures)} failed")
+            lines.extend(f"  • #{msg_id}: {reason}" for msg_id, reason in self.failures[-5:])
+        for msg_id, status in sorted(self.running.items()):
+            item_lines = (status.text or "⏳ Waiting...").splitlines()[:ITEM_LINES]
+            lines.append(f"\n#{msg_id}: " + "\n".join(item_lines))
+        return "\n".join(lines)
+
+    async def refresh(self, final=False):
+        if not self.dirty and not final:
+            return
+        self.dirty = False
+        text = self.render(final)
+        if text == self.last_text:
+            return
+        try:
+            await self.message.edit_text(text)
+            self.last_text = text
+        except Exception as e:
+            logger.debug(f"Batch progress update failed: {e}")
+
+    async def refresh_loop(self):
+        """Redraws the message while the batch runs; cancel it when the batch is over"""
+        while True:
+            await asyncio.sleep(RENDER_INTERVAL)
+            await self.refresh()
@@ -0,0 +1,139 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from bot.config import CHAT_INFO_MAX_ENTRIES, CHAT_INFO_TTL
+from bot.database import get_chat_info, save_chat_info
+from bot.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# How long a get_chat call may take before we give up on it
+RESOLVE_TIMEOUT = 10
+
+class ChatInfo:
+    __slots__ = ("chat", "type", "is_group", "has_protected_content", "resolved_at")
+
+    def __init__(self, chat, chat_type, is_group, has_protected_content, resolved_at=None):
+        self.chat = chat
+        self.type = chat_type
+        self.is_group = is_group
+        self.has_protected_content = has_protected_content
+        self.resolved_at = resolved_at or time.time()
+
+    @classmethod
+    def from_chat(cls, key, chat):
+        chat_type = getattr(chat.type, "name", str(chat.type)).lower()
+        # In Pyrogram/Hydrogram, ChatType.CHANNEL is for broadcast channels,
+        # ChatType.GROUP and ChatType.SUPERGROUP are for groups
+        is_group = "group" in chat_type or getattr(chat, "broadcast", None) is False
+        return cls(key, chat_type, is_group, bool(getattr(chat, "has_protected_content", False)))
+
+class ChatInfoCache:
+    """
+    Metadata of public chats (group or channel, content protection), shared by all users.
+
+    Lookups go memory (LRU, CHAT_INFO_MAX_ENTRIES) -> chat_info table -> client.get_chat, and
+    entries older than CHAT_INFO_TTL are resolved again. Concurrent lookups of the same chat
+    share one get_chat call.
+
+    It also remembers chats where Telegram refused a copy for content protection, so their
+    links skip the copy attempt that is bound to fail. Other copy failures (FloodWait, a
+    deleted message...) only concern the item at hand and aren't remembered.
+    """
+    def __init__(self, max_entries=CHAT_INFO_MAX_ENTRIES, ttl=CHAT_INFO_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.flights = SingleFlight()
+        # chat -> when the refusal is forgotten
+        self.copy_refused = OrderedDict()
+
+    @staticmethod
+    def key(chat):
+        return str(chat).lower()
+
+    def _fresh(self, info):
+        return info and time.time() - info.resolved_at < self.ttl
+
+    def _store(self, info):
+        self.entries[info.chat] = info
+        self.entries.move_to_end(info.chat)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def peek(self, chat):
+        """The cached entry if it is still fresh, without any I/O"""
+        key = self.key(chat)
+        info = self.entries.get(key)
+        if not self._fresh(info):
+            return None
+        self.entries.move_to_end(key)
+        return info
+
+    async def get(self, client, chat):
+        """Returns the chat's ChatInfo, calling get_chat only when no fresh copy is known"""
+        info = self.peek(chat)
+        if info:
+            return info
+
+        key = self.key(chat)
+        row = await get_chat_info(key)
+        if row:
+            # updated_at is naive UTC, like every timestamp in the database
+            resolved_at = datetime.fromisoformat(row["updated_at"]).replace(tzinfo=timezone.utc).timestamp() if row.get("updated_at") else 0
+            info = ChatInfo(key, row["type"], row["is_group"], row["has_protected_content"], resolved_at)
+            if self._fresh(info):
+                self._store(info)
+                return info
+
+        flight, is_leader = self.flights.join(key)
+        if not is_leader:
+            info = await flight.wait()
+            if info:
+                return info
+            raise LookupError(f"Could not resolve chat {chat}")
+        info = None
+        try:
+            chat_obj = await asyncio.wait_for(client.get_chat(chat), timeout=RESOLVE_TIMEOUT)
+            info = ChatInfo.from_chat(key, chat_obj)
+            self._store(info)
+            await save_chat_info(key, info.type, info.is_group, info.has_protected_content)
+            logger.info(f"Resolved chat {chat}: {info.type}, group={info.is_group}, protected={info.has_protected_content}")
+            return info
+        finally:
+            self.flights.finish(flight, info)
+
+    def invalidate(self, chat):
+        self.entries.pop(self.key(chat), None)
+        self.copy_refused.pop(self.key(chat), None)
+
+    def can_copy(self, chat):
+        """False if the chat is known to refuse copies (content protection), None if it's worth a try"""
+        info = self.peek(chat)
+        if info and info.has_protected_content:
+            return False
+        key = self.key(chat)
+        expires = self.copy_refused.get(key)
+        if expires is None:
+            return None
+        if time.time() >= expires:
+            del self.copy_refused[key]
+            return None
+        return False
+
+    async def record_copy_refused(self, chat):
+        """Records that Telegram refused a copy from the chat for content protection"""
+        key = self.key(chat)
+        info = self.peek(chat)
+        if info and not info.has_protected_content:
+            info.has_protected_content = True
+            await save_chat_info(key, info.type, info.is_group, True)
+        self.copy_refused[key] = time.time() + self.ttl
+        self.copy_refused.move_to_end(key)
+        while len(self.copy_refused) > self.max_entries:
+            self.copy_refused.popitem(last=False)
+        logger.info(f"Copying from {chat} is refused (content protection), skipping copies for {self.ttl}s")
+
+chat_info_cache = ChatInfoCache()
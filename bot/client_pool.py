@@ -0,0 +1,247 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pyrogram import Client
+from bot.config import API_ID, API_HASH, USER_CLIENT_POOL_SIZE, USER_CLIENT_IDLE_TIMEOUT
+from bot.database import get_user_peers, save_user_peers
+
+logger = logging.getLogger(__name__)
+
+class PooledClient:
+    __slots__ = ("client", "session_string", "in_use", "last_used", "known_peers")
+
+    def __init__(self, client, session_string, known_peers=None):
+        self.client = client
+        self.session_string = session_string
+        self.in_use = 0
+        self.last_used = time.time()
+        # peer_id -> (access_hash, usernames) as last persisted
+        self.known_peers = known_peers or {}
+
+async def load_peers(user_id, client):
+    """Seeds an in-memory session with the peers saved for this user, so it can resolve
+    chats without a round trip to get_dialogs/resolve_username. Returns what was loaded."""
+    known = {}
+    peers = await get_user_peers(user_id)
+    if not peers:
+        return known
+    try:
+        await client.storage.update_peers(
+            (p["peer_id"], p["access_hash"], p["type"], p["phone_number"]) for p in peers
+        )
+        usernames = [(p["peer_id"], p["usernames"].split(",")) for p in peers if p["usernames"]]
+        if usernames:
+            await client.storage.update_usernames(usernames)
+        for p in peers:
+            known[p["peer_id"]] = (p["access_hash"], p["usernames"] or "")
+        logger.debug(f"Loaded {len(peers)} saved peers into client of user {user_id}")
+    except Exception as e:
+        logger.warning(f"Could not load saved peers for {user_id}: {e}")
+    return known
+
+async def dump_peers(user_id, entry):
+    """Persists peers the session resolved since they were loaded"""
+    try:
+        conn = entry.client.storage.conn
+        usernames = {}
+        for peer_id, username in conn.execute("SELECT id, username FROM usernames"):
+            usernames.setdefault(peer_id, []).append(username)
+        changed = []
+        for peer_id, access_hash, peer_type, phone_number in conn.execute(
+            "SELECT id, access_hash, type, phone_number FROM peers"
+        ):
+            names = usernames.get(peer_id, [])
+            if entry.known_peers.get(peer_id) == (access_hash, ",".join(names)):
+                continue
+            changed.append({
+                "peer_id": peer_id,
+                "access_hash": access_hash,
+                "type": peer_type,
+                "phone_number": phone_number,
+                "usernames": names
+            })
+        if changed:
+            await save_user_peers(user_id, changed)
+            for p in changed:
+                entry.known_peers[p["peer_id"]] = (p["access_hash"], ",".join(p["usernames"]))
+            logger.debug(f"Saved {len(changed)} new peers of user {user_id}")
+    except Exception as e:
+        logger.warning(f"Could not save peers of user {user_id}: {e}")
+
+class UserClientPool:
+    """
+    Keeps started user-session clients around so repeat requests from the same user skip
+    the MTProto handshake and auth. Bounded to `max_clients` open connections, counting
+    clients being started and ones dropped from the pool while still in use (least recently
+    used idle clients are evicted first, and acquire() waits when every client is busy).
+    Clients idle for longer than `idle_timeout` seconds are stopped by idle_reaper().
+    """
+    def __init__(self, max_clients=USER_CLIENT_POOL_SIZE, idle_timeout=USER_CLIENT_IDLE_TIMEOUT):
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self.clients = OrderedDict()
+        self.locks = {}
+        self.freed = None
+        # Clients dropped from the pool while in use (stopped on release) and clients being started
+        self.detached = {}
+        self.opening = 0
+
+    def _condition(self):
+        if self.freed is None:
+            self.freed = asyncio.Condition()
+        return self.freed
+
+    async def _start_client(self, user_id, session_string, retries=3):
+        for attempt in range(retries):
+            client = Client(
+                f"user_{user_id}",
+                session_string=session_string,
+                in_memory=True,
+                api_id=API_ID,
+                api_hash=API_HASH,
+                no_updates=True
+            )
+            try:
+                await client.start()
+                return client
+            except Exception as e:
+                logger.warning(f"User client connection error for {user_id} (attempt {attempt + 1}/{retries}): {e}")
+                try:
+                    await client.stop()
+                except Exception:
+                    pass
+                if attempt < retries - 1:
+                    await asyncio.sleep(2)
+        return None
+
+    async def _stop(self, user_id, entry):
+        await dump_peers(user_id, entry)
+        try:
+            await entry.client.stop()
+        except Exception as e:
+            logger.debug(f"Error stopping pooled client for {user_id}: {e}")
+
+    async def _notify(self):
+        condition = self._condition()
+        async with condition:
+            condition.notify_all()
+
+    async def _drop(self, user_id, entry):
+        """Removes a client from the pool: stopped now if idle, else by release() once its users are done"""
+        if self.clients.get(user_id) is entry:
+            del self.clients[user_id]
+        if entry.in_use == 0:
+            await self._stop(user_id, entry)
+            await self._notify()
+        else:
+            self.detached[entry.client] = entry
+
+    def _open_count(self):
+        return len(self.clients) + len(self.detached) + self.opening
+
+    async def _make_room(self):
+        """
+        Evicts idle clients (LRU first) until there is room for one more, waiting if all are
+        busy, and reserves the slot; the caller gives it up with `self.opening -= 1`.
+        """
+        condition = self._condition()
+        async with condition:
+            while self._open_count() >= self.max_clients:
+                idle = next((uid for uid, entry in self.clients.items() if entry.in_use == 0), None)
+                if idle is not None:
+                    entry = self.clients.pop(idle)
+                    logger.info(f"Client pool full, evicting idle client of user {idle}")
+                    await self._stop(idle, entry)
+                    continue
+                await condition.wait()
+            self.opening += 1
+
+    async def acquire(self, user_id, session_string):
+        """Returns a started client for the user (or None if it can't connect). Pair with release()."""
+        lock = self.locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            entry = self.clients.get(user_id)
+            if entry and entry.session_string != session_string:
+                # User logged in again with another session
+                await self._drop(user_id, entry)
+                entry = None
+            if entry and not entry.client.is_connected:
+                await self._drop(user_id, entry)
+                entry = None
+
+            if not entry:
+                await self._make_room()
+                try:
+                    client = await self._start_client(user_id, session_string)
+                    if client:
+                        entry = PooledClient(client, session_string, await load_peers(user_id, client))
+                        self.clients[user_id] = entry
+                finally:
+                    self.opening -= 1
+                if not client:
+                    await self._notify()
+                    return None
+                logger.info(f"Client pool: started client for user {user_id} ({self._open_count()}/{self.max_clients} open)")
+
+            self.clients.move_to_end(user_id)
+            entry.in_use += 1
+            entry.last_used = time.time()
+            return entry.client
+
+    async def release(self, user_id, client=None):
+        """Hands a client back to the pool; clients dropped from the pool meanwhile are stopped"""
+        entry = self.clients.get(user_id)
+        if entry and (client is None or entry.client is client):
+            entry.in_use = max(0, entry.in_use - 1)
+            entry.last_used = time.time()
+            if entry.in_use == 0:
+                await dump_peers(user_id, entry)
+                await self._notify()
+        elif client in self.detached:
+            # Dropped from the pool while in use: the last user stops it
+            entry = self.detached[client]
+            entry.in_use = max(0, entry.in_use - 1)
+            if entry.in_use == 0:
+                del self.detached[client]
+                await self._stop(user_id, entry)
+                await self._notify()
+        elif client is not None:
+            try:
+                await client.stop()
+            except Exception:
+                pass
+
+    @asynccontextmanager
+    async def session(self, user_id, session_string):
+        client = await self.acquire(user_id, session_string)
+        try:
+            yield client
+        finally:
+            if client:
+                await self.release(user_id, client)
+
+    async def discard(self, user_id):
+        """Drops a user's client (logout, revoked session); it is stopped once no longer in use"""
+        entry = self.clients.get(user_id)
+        self.locks.pop(user_id, None)
+        if entry:
+            await self._drop(user_id, entry)
+
+    async def idle_reaper(self):
+        """Stops clients nobody used for `idle_timeout` seconds"""
+        while True:
+            await asyncio.sleep(60)
+            try:
+                now = time.time()
+                for user_id, entry in list(self.clients.items()):
+                    if entry.in_use == 0 and now - entry.last_used > self.idle_timeout:
+                        self.clients.pop(user_id, None)
+                        self.locks.pop(user_id, None)
+                        await self._stop(user_id, entry)
+                        logger.info(f"Client pool: stopped idle client of user {user_id}")
+            except Exception as e:
+                logger.error(f"Client pool reaper error: {e}")
+
+user_client_pool = UserClientPool()
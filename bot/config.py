@@ -30,17 +30,56 @@ DUMP_CHANNEL_ID = os.environ.get("DUMP_CHANNEL_ID")
 # Performance Settings
 MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", 10)) 
 MAX_CONCURRENT_UPLOADS = int(os.environ.get("MAX_CONCURRENT_UPLOADS", 10))
+# Fair scheduler (bot/scheduler.py): premium users get PREMIUM_WEIGHT times the share of slots,
+# may run PREMIUM_MAX_JOBS jobs at once and keep up to PREMIUM_MAX_PENDING submitted.
+PREMIUM_WEIGHT = int(os.environ.get("PREMIUM_WEIGHT", 4))
+PREMIUM_MAX_JOBS = int(os.environ.get("PREMIUM_MAX_JOBS", 2))
+PREMIUM_MAX_PENDING = int(os.environ.get("PREMIUM_MAX_PENDING", 5))
+FREE_MAX_PENDING = int(os.environ.get("FREE_MAX_PENDING", 1))
+# Seconds a job may wait (plus its estimated transfer time) before it jumps the fair order
+QUEUE_DEADLINE = int(os.environ.get("QUEUE_DEADLINE", 300))
+# Media-group items fetched ahead of the one being uploaded (each may hold a file on disk)
+PIPELINE_DEPTH = int(os.environ.get("PIPELINE_DEPTH", 1))
+PREMIUM_PIPELINE_DEPTH = int(os.environ.get("PREMIUM_PIPELINE_DEPTH", 3))
+# Items of one /batch downloading at the same time (they still queue for transfer slots)
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 2))
+# Stream downloads straight into the upload instead of going through downloads/
+STREAM_RELAY = os.environ.get("STREAM_RELAY", "True").lower() == "true"
+# Number of parts held in memory per relayed file (8 x 512 KB = 4 MB)
+RELAY_BUFFER_PARTS = int(os.environ.get("RELAY_BUFFER_PARTS", 8))
+# Files this big or bigger go through a resumable (checkpointed) disk download instead of the relay
+RESUMABLE_MIN_SIZE = int(os.environ.get("RESUMABLE_MIN_SIZE", 200 * 1024 * 1024))
+# Cross-user cache of delivered media (source message -> our file_id)
+MEDIA_CACHE_MAX_ENTRIES = int(os.environ.get("MEDIA_CACHE_MAX_ENTRIES", 50000))
+MEDIA_CACHE_MAX_AGE_DAYS = int(os.environ.get("MEDIA_CACHE_MAX_AGE_DAYS", 30))
+# Warm user-session clients kept connected between requests (a hard cap: requests wait when all are busy)
+USER_CLIENT_POOL_SIZE = int(os.environ.get("USER_CLIENT_POOL_SIZE", 20))
+USER_CLIENT_IDLE_TIMEOUT = int(os.environ.get("USER_CLIENT_IDLE_TIMEOUT", 600))
+# Resolved peers (access hashes) remembered per user session
+MAX_PEERS_PER_USER = int(os.environ.get("MAX_PEERS_PER_USER", 2000))
+# Files a free user may download per day
+FREE_DAILY_LIMIT = int(os.environ.get("FREE_DAILY_LIMIT", 5))
+# Users rows kept in memory by bot/database.py
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+# Download/ad counter changes are buffered and written in one transaction this often (ms),
+# or as soon as this many changes are waiting
+COUNTER_FLUSH_INTERVAL_MS = int(os.environ.get("COUNTER_FLUSH_INTERVAL_MS", 1000))
+COUNTER_FLUSH_MAX_UPDATES = int(os.environ.get("COUNTER_FLUSH_MAX_UPDATES", 500))
+# Resolved chat metadata (group/channel, content protection) shared by all users
+CHAT_INFO_MAX_ENTRIES = int(os.environ.get("CHAT_INFO_MAX_ENTRIES", 5000))
+CHAT_INFO_TTL = int(os.environ.get("CHAT_INFO_TTL", 6 * 3600))
 
 def get_smart_download_workers(file_size):
     """
     Lower worker count for downloads (optimized for server stability).
+    Each worker is a separate media-DC connection fetching its own parts.
     """
     if file_size < 10 * 1024 * 1024:
         return 1
     elif file_size < 100 * 1024 * 1024:
         return 2
     else:
-        return 2
+        return 4
 
 def get_smart_upload_workers(file_size):
     """
@@ -71,9 +110,6 @@ try:
 except ImportError:
     pass
 
-active_downloads = set()
-cancel_flags = set()
-global_download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
 global_upload_semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
 login_states = {}
 
@@ -94,11 +130,15 @@ AD_DAILY_LIMIT = int(os.environ.get("AD_DAILY_LIMIT", 5))
 AD_FOR_PREMIUM = os.environ.get("AD_FOR_PREMIUM", "False").lower() == "true"
 
 # Update client with higher max_concurrent_transmissions
+# "file" keeps the bot's auth key and peer cache in bot_session.session (and a copy of the
+# auth key in the database, so it survives cloud backup/restore); "memory" re-authorizes on every start
+BOT_SESSION_MODE = os.environ.get("BOT_SESSION_MODE", "file").lower()
+
 app = Client(
     "bot_session", 
     api_id=API_ID, 
     api_hash=API_HASH, 
     bot_token=BOT_TOKEN,
-    in_memory=True,
+    in_memory=BOT_SESSION_MODE == "memory",
     max_concurrent_transmissions=20 # Increased for multi-worker support
 )
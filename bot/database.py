@@ -1,27 +1,278 @@
 import os
+import json
 import sqlite3
+import asyncio
 import logging
 from datetime import datetime, timedelta
 from typing import Optional, Dict, List
-from threading import Lock
-from bot.config import OWNER_ID
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, RLock
+from bot.config import OWNER_ID, MEDIA_CACHE_MAX_ENTRIES, MEDIA_CACHE_MAX_AGE_DAYS, MAX_PEERS_PER_USER, CHAT_INFO_MAX_ENTRIES, USER_CACHE_SIZE, FREE_DAILY_LIMIT, COUNTER_FLUSH_INTERVAL_MS, COUNTER_FLUSH_MAX_UPDATES
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DATABASE_PATH = os.environ.get("DATABASE_PATH", "telegram_bot.db")
 
-db_lock = Lock()
 _db_initialized = False
 
+# All queries run on this one thread, over one long-lived connection: the event loop never
+# blocks on SQLite, and queries are serialized without a lock. sqlite3 keeps the prepared
+# statements of a connection (keyed by SQL text), so hot queries are compiled only once.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+_connection = None
+STATEMENT_CACHE_SIZE = 256
+
 def _get_connection():
-    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, timeout=30.0)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA synchronous=NORMAL")
-    conn.execute("PRAGMA cache_size=-64000")
-    conn.execute("PRAGMA temp_store=MEMORY")
-    return conn
+    global _connection
+    if _connection is None:
+        conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, timeout=30.0, cached_statements=STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-64000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _connection = conn
+    return _connection
+
+def _execute(query):
+    conn = _get_connection()
+    try:
+        return query(conn)
+    except BaseException:
+        # Don't leave a half-done write open for the next query to commit
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+
+async def _run(query):
+    """Runs `query(conn)` on the database thread and returns its result"""
+    return await asyncio.get_running_loop().run_in_executor(_executor, _execute, query)
+
+class UserCache:
+    """
+    LRU copy of recently used users rows, so get_user in the hot path is a dict lookup.
+    Only the database thread fills or invalidates it, inside the same query as the SQL that
+    read or changed the row, so a write can't be overtaken by an older read landing in the
+    cache after it. Reads (from the event loop) take the lock just long enough to copy a row.
+    """
+    def __init__(self, max_entries=USER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        key = str(user_id)
+        with self.lock:
+            row = self.entries.get(key)
+            if row is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            # Callers are free to modify what they get
+            return dict(row)
+
+    def put(self, row):
+        with self.lock:
+            self.entries[row['telegram_id']] = row
+            self.entries.move_to_end(row['telegram_id'])
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id=None):
+        with self.lock:
+            if user_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(str(user_id), None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+user_cache = UserCache()
+
+class CounterBuffer:
+    """
+    Write-behind buffer for the daily counters (downloads_today, ads_today). Changes are
+    summed here per user and day, and flush_counters() writes them all in one transaction,
+    every COUNTER_FLUSH_INTERVAL_MS or once COUNTER_FLUSH_MAX_UPDATES changes are waiting,
+    instead of one commit per change. get_user() adds what's still pending to the row it
+    returns, and reserve_quota() writes the user's pending changes in its own transaction
+    before counting, so the quota stays exact.
+
+    Changes are added from the event loop and written on the database thread; an entry stays
+    here until its transaction is committed, so nothing is lost if a flush fails.
+    """
+    def __init__(self, max_updates=COUNTER_FLUSH_MAX_UPDATES):
+        self.max_updates = max_updates
+        # (user id, day) -> [downloads, ads]
+        self.pending = {}
+        self.lock = RLock()
+        self.updates = 0
+        self.flushes = 0
+        self.flushed_updates = 0
+
+    def add(self, user_id, downloads=0, ads=0, day=None):
+        """Adds a change; returns True once enough are waiting that they should be flushed"""
+        key = (str(user_id), day or datetime.utcnow().date().isoformat())
+        with self.lock:
+            deltas = self.pending.setdefault(key, [0, 0])
+            deltas[0] += downloads
+            deltas[1] += ads
+            self.updates += 1
+            return self.updates >= self.max_updates
+
+    def snapshot(self, user_id=None):
+        """What's pending (for one user or everyone), as {(user id, day): (downloads, ads)}"""
+        with self.lock:
+            if user_id is None:
+                return {key: tuple(deltas) for key, deltas in self.pending.items()}
+            return {key: tuple(deltas) for key, deltas in self.pending.items() if key[0] == str(user_id)}
+
+    def settle(self, written, updates=0, rows=()):
+        """
+        Drops what a committed write took from the buffer, keeping changes that came in
+        meanwhile, and puts the `rows` it returned into user_cache under the same lock, so
+        get_user never sees a cached row that includes changes still counted as pending.
+        `updates` is how many add() calls a full flush covered (0 when only one user's
+        changes were written, by reserve_quota).
+        """
+        with self.lock:
+            for key, (downloads, ads) in written.items():
+                deltas = self.pending.get(key)
+                if deltas is None:
+                    continue
+                deltas[0] -= downloads
+                deltas[1] -= ads
+                if deltas == [0, 0]:
+                    del self.pending[key]
+            if not self.pending:
+                self.updates = 0
+            if updates:
+                self.updates = max(0, self.updates - updates)
+                self.flushes += 1
+                self.flushed_updates += updates
+            for row in rows:
+                user_cache.put(row)
+
+    def apply(self, user):
+        """Adds the user's pending changes to a users row (a dict), like the flush will"""
+        for (_, day), (downloads, ads) in sorted(self.snapshot(user['telegram_id']).items(), key=lambda item: item[0][1]):
+            for count, delta, date in (('downloads_today', downloads, 'last_download_date'), ('ads_today', ads, 'last_ad_date')):
+                if not delta or (user.get(date) or '') > day:
+                    continue
+                base = (user.get(count) or 0) if user.get(date) == day else 0
+                user[count] = max(0, base + delta)
+                user[date] = day
+        return user
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending_users": len(self.pending),
+                "pending_updates": self.updates,
+                "flushes": self.flushes,
+                "flushed_updates": self.flushed_updates
+            }
+
+counter_buffer = CounterBuffer()
+
+def _write_counters(conn, user_id=None):
+    """
+    Writes the pending counter changes (of one user, or everyone) in the open transaction;
+    the caller commits and then settles the returned snapshot. Changes dated before the day a
+    row is already on are dropped (that day's counter has been reset anyway), and a change on
+    a new day starts the counter from 0.
+    """
+    written = counter_buffer.snapshot(user_id)
+    if not written:
+        return written, []
+    rows = []
+    for (telegram_id, day), (downloads, ads) in written.items():
+        cursor = conn.execute('''
+            UPDATE users SET
+                downloads_today = CASE
+                    WHEN :downloads = 0 OR last_download_date > :day THEN downloads_today
+                    WHEN last_download_date = :day THEN MAX(0, downloads_today + :downloads)
+                    ELSE MAX(0, :downloads) END,
+                last_download_date = CASE WHEN :downloads = 0 OR last_download_date > :day THEN last_download_date ELSE :day END,
+                ads_today = CASE
+                    WHEN :ads = 0 OR last_ad_date > :day THEN ads_today
+                    WHEN last_ad_date = :day THEN MAX(0, ads_today + :ads)
+                    ELSE MAX(0, :ads) END,
+                last_ad_date = CASE WHEN :ads = 0 OR last_ad_date > :day THEN last_ad_date ELSE :day END
+            WHERE telegram_id = :user_id
+            RETURNING *
+        ''', {"user_id": telegram_id, "day": day, "downloads": downloads, "ads": ads})
+        row = cursor.fetchone()
+        if row:
+            rows.append(dict(row))
+    return written, rows
+
+def _flush_counters(conn):
+    updates = counter_buffer.stats()["pending_updates"]
+    written, rows = _write_counters(conn)
+    if not written:
+        return 0
+    conn.commit()
+    counter_buffer.settle(written, updates, rows)
+    return len(written)
+
+_flush_scheduled = False
+
+async def flush_counters():
+    """Writes every pending counter change in one transaction"""
+    global _flush_scheduled
+    _flush_scheduled = False
+    try:
+        flushed = await _run(_flush_counters)
+        if flushed:
+            logger.debug(f"Flushed counters of {flushed} user(s) in one commit")
+    except Exception as e:
+        logger.error(f"Error flushing counters: {e}")
+
+def _add_counters(user_id, downloads=0, ads=0):
+    global _flush_scheduled
+    if counter_buffer.add(user_id, downloads, ads) and not _flush_scheduled:
+        _flush_scheduled = True
+        asyncio.get_running_loop().create_task(flush_counters())
+
+async def counter_flush_loop():
+    """Flushes the counter buffer every COUNTER_FLUSH_INTERVAL_MS"""
+    while True:
+        await asyncio.sleep(COUNTER_FLUSH_INTERVAL_MS / 1000)
+        await flush_counters()
+
+def close_db():
+    """Writes the pending counters and closes the connection (waiting for queries already submitted). Called at shutdown."""
+    def close():
+        global _connection
+        try:
+            flushed = _execute(_flush_counters)
+            if flushed:
+                logger.info(f"Flushed counters of {flushed} user(s) at shutdown")
+        except Exception as e:
+            logger.error(f"Error flushing counters at shutdown: {e}")
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+    _executor.submit(close).result()
+    user_cache.invalidate()
 
 def init_db():
     global _db_initialized
@@ -29,8 +280,7 @@ def init_db():
         return
     
     try:
-        with db_lock:
-            conn = _get_connection()
+        def query(conn):
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -59,11 +309,71 @@ def init_db():
                 )
             ''')
             
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS media_cache (
+                    source_chat TEXT NOT NULL,
+                    source_message_id INTEGER NOT NULL,
+                    file_unique_id TEXT,
+                    file_id TEXT NOT NULL,
+                    media_type TEXT,
+                    hits INTEGER DEFAULT 0,
+                    created_at TEXT,
+                    last_used_at TEXT,
+                    PRIMARY KEY (source_chat, source_message_id)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_peers (
+                    telegram_id TEXT NOT NULL,
+                    peer_id INTEGER NOT NULL,
+                    access_hash INTEGER,
+                    type TEXT NOT NULL,
+                    phone_number TEXT,
+                    usernames TEXT,
+                    updated_at TEXT,
+                    PRIMARY KEY (telegram_id, peer_id)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    telegram_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT DEFAULT 'running',
+                    progress INTEGER DEFAULT 0,
+                    quota_charged INTEGER DEFAULT 0,
+                    attempts INTEGER DEFAULT 1,
+                    error TEXT,
+                    created_at TEXT,
+                    updated_at TEXT
+                )
+            ''')
+            # Databases created before quota_charged existed
+            job_columns = [row[1] for row in cursor.execute('PRAGMA table_info(jobs)')]
+            if 'quota_charged' not in job_columns:
+                cursor.execute('ALTER TABLE jobs ADD COLUMN quota_charged INTEGER DEFAULT 0')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chat_info (
+                    chat TEXT PRIMARY KEY,
+                    type TEXT,
+                    is_group INTEGER DEFAULT 0,
+                    has_protected_content INTEGER DEFAULT 0,
+                    updated_at TEXT
+                )
+            ''')
+            
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_banned ON users(is_banned)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_cache_last_used ON media_cache(last_used_at)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)')
             
             conn.commit()
-            conn.close()
+        # Runs before the event loop starts, so it just waits for the database thread
+        _executor.submit(_execute, query).result()
             
         _db_initialized = True
         logger.info(f"SQLite database initialized: {DATABASE_PATH}")
@@ -73,15 +383,24 @@ def init_db():
 
 async def get_user(user_id) -> Optional[Dict]:
     try:
-        with db_lock:
-            conn = _get_connection()
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (str(user_id),))
-            row = cursor.fetchone()
-            conn.close()
+        # Pending counter changes are added while no flush can settle them in between: under
+        # the buffer lock for a cached row, on the database thread for one read from disk
+        with counter_buffer.lock:
+            user = user_cache.get(user_id)
+            if user is not None:
+                counter_buffer.apply(user)
+        if user is None:
+            def query(conn):
+                cursor = conn.cursor()
+                cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (str(user_id),))
+                row = cursor.fetchone()
+                if not row:
+                    return None
+                user_cache.put(dict(row))
+                return counter_buffer.apply(dict(row))
+            user = await _run(query)
         
-        if row:
-            user = dict(row)
+        if user:
             user['is_banned'] = bool(user['is_banned'])
             user['is_agreed_terms'] = bool(user['is_agreed_terms'])
             
@@ -108,22 +427,23 @@ async def create_user(user_id) -> Optional[Dict]:
         now = datetime.utcnow().isoformat()
         today = datetime.utcnow().date().isoformat()
         
-        with db_lock:
-            conn = _get_connection()
+        def query(conn):
             cursor = conn.cursor()
             
             cursor.execute('SELECT 1 FROM users WHERE telegram_id = ?', (str(user_id),))
             if cursor.fetchone():
-                conn.close()
-                return await get_user(user_id)
+                return False
             
             cursor.execute('''
                 INSERT INTO users (telegram_id, role, downloads_today, last_download_date, 
                                    is_agreed_terms, is_banned, ads_today, created_at, updated_at)
                 VALUES (?, 'free', 0, ?, 0, 0, 0, ?, ?)
             ''', (str(user_id), today, now, now))
+            user_cache.invalidate(user_id)
             conn.commit()
-            conn.close()
+            return True
+        if not await _run(query):
+            return await get_user(user_id)
         
         return {
             "telegram_id": str(user_id),
@@ -142,38 +462,42 @@ async def create_user(user_id) -> Optional[Dict]:
 
 async def update_user_terms(user_id, agreed=True):
     try:
-        with db_lock:
-            conn = _get_connection()
+        def query(conn):
             cursor = conn.cursor()
             cursor.execute('UPDATE users SET is_agreed_terms = ?, updated_at = ? WHERE telegram_id = ?',
                            (1 if agreed else 0, datetime.utcnow().isoformat(), str(user_id)))
+            user_cache.invalidate(user_id)
             conn.commit()
-            conn.close()
+        await _run(query)
     except Exception as e:
         logger.error(f"Error updating terms for {user_id}: {e}")
 
 async def save_session_string(user_id, session_string):
     try:
-        with db_lock:
-            conn = _get_connection()
+        def query(conn):
             cursor = conn.cursor()
             cursor.execute('UPDATE users SET phone_session_string = ?, updated_at = ? WHERE telegram_id = ?',
                            (session_string, datetime.utcnow().isoformat(), str(user_id)))
+            # A new login may be a different account, whose access hashes differ
+            cursor.execute('DELETE FROM user_peers WHERE telegram_id = ?', (str(user_id),))
+            user_cache.invalidate(user_id)
             conn.commit()
-            conn.close()
+        await _run(query)
         logger.info(f"Saved session for user {user_id}")
     except Exception as e:
         logger.error(f"Error saving session for {user_id}: {e}")
 
 async def logout_user(user_id):
     try:
-        with db_lock:
-            conn = _get_connection()
+        def query(conn):
             cursor = conn.cursor()
             cursor.execute('UPDATE users SET phone_session_string = NULL, updated_at = ? WHERE telegram_id = ?',
                            (datetime.utcnow().isoformat(), str(user_id)))
+            # Access hashes belong to the account that logged out
+            cursor.execute('DELETE FROM user_peers WHERE telegram_id = ?', (str(user_id),))
+            user_cache.invalidate(user_id)
             conn.commit()
-            conn.close()
+        await _run(query)
         logger.info(f"User {user_id} logged out")
     except Exception as e:
         logger.error(f"Error logging out user {user_id}: {e}")
@@ -184,140 +508,126 @@ async def set_user_role(user_id, role, duration_days=None):
         if role == 'premium' and duration_days:
             expiry_date = (datetime.utcnow() + timedelta(days=int(duration_days))).isoformat()
         
-        with db_lock:
-            conn = _get_connection()
+        def query(conn):
             cursor = conn.cursor()
             cursor.execute('UPDATE users SET role = ?, premium_expiry_date = ?, updated_at = ? WHERE telegram_id = ?',
                            (role, expiry_date, datetime.utcnow().isoformat(), str(user_id)))
+            user_cache.invalidate(user_id)
             conn.commit()
-            conn.close()
+        await _run(query)
     except Exception as e:
         logger.error(f"Error setting role for {user_id}: {e}")
 
 async def ban_user(user_id, is_banned=True):
     try:
-        with db_lock:
-            conn = _get_connection()
+        def query(conn):
             cursor = conn.cursor()
             cursor.execute('UPDATE users SET is_banned = ?, updated_at = ? WHERE telegram_id = ?',
                            (1 if is_banned else 0, datetime.utcnow().isoformat(), str(user_id)))
+            user_cache.invalidate(user_id)
             conn.commit()
-            conn.close()
+        await _run(query)
     except Exception as e:
         logger.error(f"Error banning user {user_id}: {e}")
 
-async def check_and_update_quota(user_id):
+async def save_user_counters(user_id, downloads=0, ads=0, expire_premium=False):
+    """
+    Saves a request's counter changes: `downloads`/`ads` go to the counter buffer (added to
+    today's counters at the next flush), and an expired premium role is dropped right away.
+    """
     try:
-        user = await get_user(user_id)
-        if not user:
-            return False, "User not found."
-        
-        if user.get("is_banned"):
-            return False, "You are banned from using this bot."
-        
+        if downloads or ads:
+            _add_counters(user_id, downloads=downloads, ads=ads)
+        if not expire_premium:
+            return
         today = datetime.utcnow().date().isoformat()
-        
-        if user.get("role") == 'premium' and user.get("premium_expiry_date"):
-            if user["premium_expiry_date"] < today:
-                await set_user_role(user_id, "free")
-                user["role"] = "free"
-        
-        if user.get("role") in ['premium', 'admin', 'owner']:
-            return True, "Unlimited"
-        
-        if user.get("last_download_date") != today:
-            with db_lock:
-                conn = _get_connection()
-                cursor = conn.cursor()
-                cursor.execute('UPDATE users SET downloads_today = 0, last_download_date = ? WHERE telegram_id = ?',
-                               (today, str(user_id)))
-                conn.commit()
-                conn.close()
-            user["downloads_today"] = 0
-        
-        if user.get("downloads_today", 0) >= 5:
-            return False, "Daily limit reached (5/5). Upgrade to Premium for unlimited downloads."
-        
-        return True, f"{user.get('downloads_today', 0)}/5"
-    except Exception as e:
-        logger.error(f"Error checking quota for {user_id}: {e}")
-        return False, "Database error."
-
-async def increment_quota(user_id, count=1):
-    try:
-        with db_lock:
-            conn = _get_connection()
+        def query(conn):
             cursor = conn.cursor()
-            cursor.execute('UPDATE users SET downloads_today = downloads_today + ? WHERE telegram_id = ?',
-                           (count, str(user_id)))
+            cursor.execute('''
+                UPDATE users SET role = 'free', premium_expiry_date = NULL, updated_at = ?
+                WHERE telegram_id = ? AND role = 'premium' AND premium_expiry_date < ?
+                RETURNING *
+            ''', (datetime.utcnow().isoformat(), str(user_id), today))
+            # Keep the cached row current instead of dropping it: the next request reads it right away
+            row = cursor.fetchone()
+            if row:
+                user_cache.put(dict(row))
             conn.commit()
-            conn.close()
+        await _run(query)
     except Exception as e:
-        logger.error(f"Error incrementing quota for {user_id}: {e}")
+        logger.error(f"Error saving counters for {user_id}: {e}")
 
-async def increment_ad_count(user_id):
+async def reserve_quota(user_id, count):
+    """
+    Reserves up to `count` downloads for the user in one statement: resets the counter on a
+    new day, drops an expired premium role, and counts min(count, what's left today) against
+    the quota (all of `count` for unlimited roles). Banned or unknown users get nothing.
+    Returns (granted, is_unlimited); give back what isn't used with release_quota().
+    """
     try:
         today = datetime.utcnow().date().isoformat()
-        with db_lock:
-            conn = _get_connection()
+        def query(conn):
+            # Buffered counter changes go in first (same transaction), so the count is exact
+            written, _ = _write_counters(conn, user_id)
             cursor = conn.cursor()
-            cursor.execute('UPDATE users SET ads_today = ads_today + 1, last_ad_date = ? WHERE telegram_id = ?',
-                           (today, str(user_id)))
+            # The MATERIALIZED CTE is evaluated once, before the row changes, so RETURNING
+            # can report how much was granted
+            cursor.execute('''
+                WITH current AS MATERIALIZED (
+                    SELECT
+                        (role = 'premium' AND COALESCE(premium_expiry_date < :today, 0)) AS expired,
+                        (role IN ('admin', 'owner') OR (role = 'premium' AND NOT COALESCE(premium_expiry_date < :today, 0))) AS unlimited,
+                        (CASE WHEN last_download_date = :today THEN downloads_today ELSE 0 END) AS used
+                    FROM users WHERE telegram_id = :user_id AND is_banned = 0
+                ),
+                reservation AS MATERIALIZED (
+                    SELECT expired, unlimited, used,
+                           (CASE WHEN unlimited THEN :count ELSE MIN(:count, MAX(0, :limit - used)) END) AS granted
+                    FROM current
+                )
+                UPDATE users SET
+                    role = CASE WHEN (SELECT expired FROM reservation) THEN 'free' ELSE role END,
+                    premium_expiry_date = CASE WHEN (SELECT expired FROM reservation) THEN NULL ELSE premium_expiry_date END,
+                    downloads_today = (SELECT used + granted FROM reservation),
+                    last_download_date = :today,
+                    updated_at = :now
+                WHERE telegram_id = :user_id AND is_banned = 0
+                RETURNING *, (SELECT granted FROM reservation) AS granted, (SELECT unlimited FROM reservation) AS unlimited
+            ''', {"user_id": str(user_id), "today": today, "count": int(count), "limit": FREE_DAILY_LIMIT,
+                  "now": datetime.utcnow().isoformat()})
+            row = cursor.fetchone()
             conn.commit()
-            conn.close()
-    except Exception as e:
-        logger.error(f"Error incrementing ad count for {user_id}: {e}")
-
-async def get_ad_count_today(user_id):
-    try:
-        user = await get_user(user_id)
-        if not user:
-            return 0
-        
-        today = datetime.utcnow().date().isoformat()
-        if user.get("last_ad_date") != today:
-            with db_lock:
-                conn = _get_connection()
-                cursor = conn.cursor()
-                cursor.execute('UPDATE users SET ads_today = 0, last_ad_date = ? WHERE telegram_id = ?',
-                               (today, str(user_id)))
-                conn.commit()
-                conn.close()
-            return 0
-        return user.get("ads_today", 0)
+            if not row:
+                counter_buffer.settle(written)
+                user_cache.invalidate(user_id)
+                return 0, False
+            user = dict(row)
+            granted, unlimited = user.pop('granted'), bool(user.pop('unlimited'))
+            counter_buffer.settle(written, rows=[user])
+            return granted, unlimited
+        return await _run(query)
     except Exception as e:
-        logger.error(f"Error getting ad count for {user_id}: {e}")
-        return 0
+        logger.error(f"Error reserving quota for {user_id}: {e}")
+        return 0, False
 
-async def get_remaining_quota(user_id):
+async def release_quota(user_id, count):
+    """Gives back reserved downloads that weren't used (only while it's still the same day)"""
+    if count <= 0:
+        return
     try:
-        user = await get_user(user_id)
-        if not user:
-            return 0, False
-        
-        if user.get("role") in ['premium', 'admin', 'owner']:
-            return 999999, True
-        
-        today = datetime.utcnow().date().isoformat()
-        downloads_today = user.get("downloads_today", 0)
-        
-        if user.get("last_download_date") != today:
-            downloads_today = 0
-        
-        remaining = max(0, 5 - downloads_today)
-        return remaining, False
+        # Buffered like any other counter change; the next reserve_quota writes it first
+        _add_counters(user_id, downloads=-int(count))
     except Exception as e:
-        logger.error(f"Error getting remaining quota for {user_id}: {e}")
-        return 0, False
+        logger.error(f"Error releasing quota for {user_id}: {e}")
 
 async def get_setting(key):
     try:
-        with db_lock:
-            conn = _get_connection()
+        def query(conn):
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM settings WHERE key = ?', (key,))
             row = cursor.fetchone()
-            conn.close()
+            return row
+        row = await _run(query)
         
         if row:
             return dict(row)
@@ -328,8 +638,7 @@ async def get_setting(key):
 
 async def update_setting(key, value, json_value=None):
     try:
-        with db_lock:
-            conn = _get_connection()
+        def query(conn):
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO settings (key, value, json_value, updated_at)
@@ -338,18 +647,18 @@ async def update_setting(key, value, json_value=None):
             ''', (key, value, json_value, datetime.utcnow().isoformat(),
                   value, json_value, datetime.utcnow().isoformat()))
             conn.commit()
-            conn.close()
+        await _run(query)
     except Exception as e:
         logger.error(f"Error updating setting {key}: {e}")
 
 async def get_all_users() -> List[Dict]:
     try:
-        with db_lock:
-            conn = _get_connection()
+        def query(conn):
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM users')
             rows = cursor.fetchall()
-            conn.close()
+            return rows
+        rows = await _run(query)
         
         users = []
         for row in rows:
@@ -364,13 +673,308 @@ async def get_all_users() -> List[Dict]:
 
 async def get_user_count():
     try:
-        with db_lock:
-            conn = _get_connection()
+        def query(conn):
             cursor = conn.cursor()
             cursor.execute('SELECT COUNT(*) FROM users')
             count = cursor.fetchone()[0]
-            conn.close()
+            return count
+        count = await _run(query)
         return count
     except Exception as e:
         logger.error(f"Error getting user count: {e}")
         return 0
+
+def _media_cache_key(source_chat):
+    # Public usernames are case-insensitive, numeric ids are left as they are
+    return str(source_chat).lower()
+
+async def get_cached_media(source_chat, message_id, file_unique_id=None) -> Optional[Dict]:
+    """Returns the bot-side file_id we already delivered for a source message, if still valid"""
+    try:
+        key = _media_cache_key(source_chat)
+        now = datetime.utcnow()
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM media_cache WHERE source_chat = ? AND source_message_id = ?',
+                           (key, int(message_id)))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            
+            expired = row['created_at'] < (now - timedelta(days=MEDIA_CACHE_MAX_AGE_DAYS)).isoformat()
+            # A different file_unique_id means the post was edited to carry other media
+            replaced = file_unique_id and row['file_unique_id'] and row['file_unique_id'] != file_unique_id
+            if expired or replaced:
+                cursor.execute('DELETE FROM media_cache WHERE source_chat = ? AND source_message_id = ?',
+                               (key, int(message_id)))
+                conn.commit()
+                return None
+            
+            cursor.execute('UPDATE media_cache SET hits = hits + 1, last_used_at = ? WHERE source_chat = ? AND source_message_id = ?',
+                           (now.isoformat(), key, int(message_id)))
+            conn.commit()
+            return row
+        row = await _run(query)
+        return dict(row) if row else None
+    except Exception as e:
+        logger.error(f"Error getting cached media {source_chat}/{message_id}: {e}")
+        return None
+
+async def save_cached_media(source_chat, message_id, file_unique_id, file_id, media_type=None):
+    """Remembers the file_id of our first successful upload of a source message (LRU-bounded)"""
+    try:
+        key = _media_cache_key(source_chat)
+        now = datetime.utcnow()
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO media_cache (source_chat, source_message_id, file_unique_id, file_id, media_type,
+                                         hits, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, 0, ?, ?)
+                ON CONFLICT(source_chat, source_message_id) DO UPDATE SET
+                    file_unique_id = excluded.file_unique_id, file_id = excluded.file_id,
+                    media_type = excluded.media_type, created_at = excluded.created_at,
+                    last_used_at = excluded.last_used_at
+            ''', (key, int(message_id), file_unique_id, file_id, media_type, now.isoformat(), now.isoformat()))
+            
+            cursor.execute('DELETE FROM media_cache WHERE created_at < ?',
+                           ((now - timedelta(days=MEDIA_CACHE_MAX_AGE_DAYS)).isoformat(),))
+            cursor.execute('''
+                DELETE FROM media_cache WHERE rowid IN (
+                    SELECT rowid FROM media_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (MEDIA_CACHE_MAX_ENTRIES,))
+            conn.commit()
+        await _run(query)
+    except Exception as e:
+        logger.error(f"Error caching media {source_chat}/{message_id}: {e}")
+
+async def invalidate_cached_media(source_chat, message_id):
+    """Drops a cache entry Telegram no longer accepts (stale file reference, deleted file...)"""
+    try:
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM media_cache WHERE source_chat = ? AND source_message_id = ?',
+                           (_media_cache_key(source_chat), int(message_id)))
+            conn.commit()
+        await _run(query)
+    except Exception as e:
+        logger.error(f"Error invalidating cached media {source_chat}/{message_id}: {e}")
+
+async def get_chat_info(chat) -> Optional[Dict]:
+    """Metadata of a public chat resolved earlier (see bot/chat_cache.py)"""
+    try:
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM chat_info WHERE chat = ?', (_media_cache_key(chat),))
+            row = cursor.fetchone()
+            return row
+        row = await _run(query)
+        if row:
+            info = dict(row)
+            info['is_group'] = bool(info['is_group'])
+            info['has_protected_content'] = bool(info['has_protected_content'])
+            return info
+        return None
+    except Exception as e:
+        logger.error(f"Error getting chat info {chat}: {e}")
+        return None
+
+async def save_chat_info(chat, chat_type, is_group, has_protected_content):
+    """Stores a chat's resolved metadata, keeping the CHAT_INFO_MAX_ENTRIES most recent"""
+    try:
+        now = datetime.utcnow().isoformat()
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO chat_info (chat, type, is_group, has_protected_content, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(chat) DO UPDATE SET
+                    type = excluded.type, is_group = excluded.is_group,
+                    has_protected_content = excluded.has_protected_content, updated_at = excluded.updated_at
+            ''', (_media_cache_key(chat), chat_type, int(bool(is_group)), int(bool(has_protected_content)), now))
+            cursor.execute('''
+                DELETE FROM chat_info WHERE rowid IN (
+                    SELECT rowid FROM chat_info ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (CHAT_INFO_MAX_ENTRIES,))
+            conn.commit()
+        await _run(query)
+    except Exception as e:
+        logger.error(f"Error saving chat info {chat}: {e}")
+
+async def get_user_peers(user_id) -> List[Dict]:
+    """Peers (ids + access hashes) a user's session has resolved before"""
+    try:
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('SELECT peer_id, access_hash, type, phone_number, usernames FROM user_peers WHERE telegram_id = ?',
+                           (str(user_id),))
+            rows = cursor.fetchall()
+            return rows
+        rows = await _run(query)
+        return [dict(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Error getting peers for {user_id}: {e}")
+        return []
+
+async def save_user_peers(user_id, peers):
+    """Upserts peers as dicts with peer_id, access_hash, type, phone_number, usernames (list)"""
+    if not peers:
+        return
+    try:
+        now = datetime.utcnow().isoformat()
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO user_peers (telegram_id, peer_id, access_hash, type, phone_number, usernames, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(telegram_id, peer_id) DO UPDATE SET
+                    access_hash = excluded.access_hash, type = excluded.type, phone_number = excluded.phone_number,
+                    usernames = excluded.usernames, updated_at = excluded.updated_at
+            ''', [
+                (str(user_id), p['peer_id'], p['access_hash'], p['type'], p.get('phone_number'),
+                 ",".join(u for u in p.get('usernames') or [] if u), now)
+                for p in peers
+            ])
+            cursor.execute('''
+                DELETE FROM user_peers WHERE telegram_id = ? AND peer_id IN (
+                    SELECT peer_id FROM user_peers WHERE telegram_id = ? ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (str(user_id), str(user_id), MAX_PEERS_PER_USER))
+            conn.commit()
+        await _run(query)
+    except Exception as e:
+        logger.error(f"Error saving peers for {user_id}: {e}")
+
+async def create_job(user_id, kind, payload, status='running') -> Optional[int]:
+    """Records a download ('link') or batch job so it can be resumed after a restart"""
+    try:
+        now = datetime.utcnow().isoformat()
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO jobs (telegram_id, kind, payload, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (str(user_id), kind, json.dumps(payload), status, now, now))
+            job_id = cursor.lastrowid
+            conn.commit()
+            return job_id
+        job_id = await _run(query)
+        return job_id
+    except Exception as e:
+        logger.error(f"Error creating job for {user_id}: {e}")
+        return None
+
+async def update_job_progress(job_id, progress):
+    """Progress is job specific: files delivered for a link, next message id for a batch"""
+    if not job_id:
+        return
+    try:
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?',
+                           (progress, datetime.utcnow().isoformat(), job_id))
+            conn.commit()
+        await _run(query)
+    except Exception as e:
+        logger.error(f"Error updating job {job_id}: {e}")
+
+async def update_job_quota(job_id, charged):
+    """Files of a link job counted against the user's quota so far, so a resumed job isn't charged again"""
+    if not job_id:
+        return
+    try:
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('UPDATE jobs SET quota_charged = ?, updated_at = ? WHERE id = ?',
+                           (charged, datetime.utcnow().isoformat(), job_id))
+            conn.commit()
+        await _run(query)
+    except Exception as e:
+        logger.error(f"Error updating quota of job {job_id}: {e}")
+
+async def finish_job(job_id, status='done', error=None):
+    if not job_id:
+        return
+    try:
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?',
+                           (status, error, datetime.utcnow().isoformat(), job_id))
+            conn.commit()
+        await _run(query)
+    except Exception as e:
+        logger.error(f"Error finishing job {job_id}: {e}")
+
+async def claim_job() -> Optional[Dict]:
+    """Atomically takes the oldest queued job and marks it running"""
+    try:
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ?
+                WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1)
+                RETURNING *
+            ''', (datetime.utcnow().isoformat(),))
+            row = cursor.fetchone()
+            conn.commit()
+            return row
+        row = await _run(query)
+        if not row:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        return job
+    except Exception as e:
+        logger.error(f"Error claiming job: {e}")
+        return None
+
+async def requeue_interrupted_jobs(max_attempts=3, keep_days=7):
+    """
+    Run once at startup, before any new job is created: jobs still marked running were cut off
+    by the restart and go back to the queue, unless they already failed that way too often.
+    Finished jobs older than `keep_days` are dropped.
+    """
+    try:
+        now = datetime.utcnow()
+        def query(conn):
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE jobs SET status = 'failed', error = 'interrupted too many times', updated_at = ?
+                WHERE status = 'running' AND attempts >= ?
+            ''', (now.isoformat(), max_attempts))
+            cursor.execute("UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running'",
+                           (now.isoformat(),))
+            requeued = cursor.rowcount
+            cursor.execute("DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND updated_at < ?",
+                           ((now - timedelta(days=keep_days)).isoformat(),))
+            conn.commit()
+            return requeued
+        requeued = await _run(query)
+        if requeued:
+            logger.info(f"Requeued {requeued} interrupted jobs")
+        return requeued
+    except Exception as e:
+        logger.error(f"Error requeueing jobs: {e}")
+        return 0
+
+async def cancel_user_jobs(user_id=None):
+    """Marks queued jobs (of one user, or everyone's) cancelled so the worker won't pick them up"""
+    try:
+        def query(conn):
+            cursor = conn.cursor()
+            if user_id is None:
+                cursor.execute("UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE status = 'queued'",
+                               (datetime.utcnow().isoformat(),))
+            else:
+                cursor.execute("UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE status = 'queued' AND telegram_id = ?",
+                               (datetime.utcnow().isoformat(), str(user_id)))
+            count = cursor.rowcount
+            conn.commit()
+            return count
+        count = await _run(query)
+        return count
+    except Exception as e:
+        logger.error(f"Error cancelling jobs: {e}")
+        return 0
@@ -1,12 +1,23 @@
 import asyncio
 import os
+import logging
 import time
 import io
 import aiofiles
-from pyrogram import filters, Client
+from pyrogram import filters
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
-from bot.config import app, API_ID, API_HASH, active_downloads, global_download_semaphore
-from bot.database import get_user, check_and_update_quota, increment_quota, get_setting, get_remaining_quota
+from bot.config import app, global_upload_semaphore, STREAM_RELAY, RESUMABLE_MIN_SIZE, PIPELINE_DEPTH, PREMIUM_PIPELINE_DEPTH, BATCH_CONCURRENCY, FREE_DAILY_LIMIT
+from pyrogram.errors import BadRequest, ChatForwardsRestricted, FileReferenceExpired
+from bot.singleflight import SingleFlight
+from bot.client_pool import user_client_pool
+from bot.scheduler import scheduler
+from bot.task_registry import running_tasks
+from bot.links import parse_link
+from bot.chat_cache import chat_info_cache
+from bot.message_batcher import message_batcher
+from bot.batch import BatchProgress
+from bot.user_context import UserContext
+from bot.database import get_user, get_setting, get_cached_media, save_cached_media, invalidate_cached_media, create_job, update_job_progress, update_job_quota, finish_job
 
 async def progress_bar(current, total, message, type_msg):
     if total == 0:
@@ -16,7 +27,8 @@ async def progress_bar(current, total, message, type_msg):
     if not hasattr(progress_bar, "data"):
         setattr(progress_bar, "data", {})
     
-    msg_id = message.id
+    # Per message and label, so concurrent download and upload stages keep separate speeds
+    msg_id = (message.id, type_msg)
     if msg_id not in progress_bar.data:
         progress_bar.data[msg_id] = {
             "last_val": 0,
@@ -80,7 +92,7 @@ async def progress_bar(current, total, message, type_msg):
         progress_bar.data.pop(msg_id, None)
         try:
             await message.edit_text(f"**{type_msg} Completed!**\n📦 **Total Size:** `{format_size(total)}`")
-        except:
+        except Exception:
             pass
     else:
         data["last_edit"] = now
@@ -89,6 +101,9 @@ async def progress_bar(current, total, message, type_msg):
         except Exception:
             pass
 
+# Identical concurrent transfers (same source file) share one leader's transfer
+transfer_flights = SingleFlight(progress_bar)
+
 async def verify_force_sub(client, user_id):
     from bot.config import OWNER_ID
     
@@ -148,20 +163,15 @@ async def batch_command(client, message):
         start_link = parts[1]
         end_link = parts[2]
         
-        import re
-        start_match = re.search(r"t\.me/([^/]+)/(\d+)", start_link) or re.search(r"t\.me/c/(\d+)/(\d+)", start_link)
-        end_match = re.search(r"t\.me/([^/]+)/(\d+)", end_link) or re.search(r"t\.me/c/(\d+)/(\d+)", end_link)
+        start = parse_link(start_link)
+        end = parse_link(end_link)
         
-        if not start_match or not end_match:
+        if not start or not end or start.is_story or end.is_story or start.chat_id != end.chat_id:
             await message.reply("❌ Invalid links provided.")
             return
             
-        chat_id = start_match.group(1)
-        if "t.me/c/" in start_link:
-            chat_id = int("-100" + chat_id)
-            
-        start_id = int(start_match.group(2))
-        end_id = int(end_match.group(2))
+        start_id = start.message_id
+        end_id = end.message_id
         
         if start_id > end_id:
             start_id, end_id = end_id, start_id
@@ -171,22 +181,106 @@ async def batch_command(client, message):
             await message.reply("⚠️ You can only batch up to 50 messages at a time.")
             return
             
-        await message.reply(f"🚀 Starting batch download of {count} messages...")
-        
-        for msg_id in range(start_id, end_id + 1):
-            # Create a mock message to reuse download_handler logic
-            mock_message = message
-            mock_message.text = f"https://t.me/{start_match.group(1)}/{msg_id}"
-            if "t.me/c/" in start_link:
-                 mock_message.text = f"https://t.me/c/{start_match.group(1)}/{msg_id}"
-            
-            await download_handler(client, mock_message)
-            # Increased delay to 10 seconds to prevent floodwait from Telegram
-            await asyncio.sleep(10) 
+        await running_tasks.run(user_id, run_batch(client, user_id, start.chat, start_id, end_id, start.is_private))
             
     except Exception as e:
         await message.reply(f"❌ Batch error: {str(e)}")
 
+async def run_batch(client, user_id, chat, start_id, end_id, is_private, job_id=None, next_id=None):
+    """Downloads messages start_id..end_id of `chat`, BATCH_CONCURRENCY at a time, resumable from `next_id`"""
+    if job_id is None:
+        job_id = await create_job(user_id, "batch", {
+            "chat": chat, "start_id": start_id, "end_id": end_id, "private": is_private
+        })
+    chat_id = int("-100" + str(chat)) if is_private else chat
+    status = "failed"
+    progress = None
+    refresher = None
+    # Shared by all items: the user is read once per batch
+    ctx = await UserContext.load(user_id)
+    
+    try:
+        # Checked once per batch rather than per message as single links are
+        is_subbed, channel = await verify_force_sub(client, user_id)
+        allowed, msg_quota = ctx.check_quota()
+        if not is_subbed and channel:
+            await client.send_message(user_id, f"⛔ You must join our channel to use this bot.\n\n👉 {channel}")
+            return
+        if not allowed:
+            await client.send_message(user_id, f"⛔ {msg_quota}")
+            return
+        
+        # Fetch the whole range up front (one call per 200 ids) to spot media groups
+        msg_ids = range(next_id or start_id, end_id + 1)
+        messages = {}
+        try:
+            session_str = ctx.session_string
+            
+            # Use user client if private link, else main client
+            if is_private and session_str:
+                async with user_client_pool.session(user_id, session_str) as peek_client:
+                    if peek_client:
+                        messages = await message_batcher.get_many(peek_client, chat_id, msg_ids)
+            else:
+                messages = await message_batcher.get_many(client, chat_id, msg_ids)
+        except Exception as e:
+            logging.warning(f"Batch prefetch failed: {e}")
+        
+        # One item per album (run_download fetches the whole group), nothing for empty messages
+        items = []
+        seen_media_groups = set()
+        for msg_id in msg_ids:
+            m = messages.get(msg_id)
+            if m is not None and getattr(m, "empty", False):
+                continue
+            if m is not None and m.media_group_id:
+                if m.media_group_id in seen_media_groups:
+                    continue
+                seen_media_groups.add(m.media_group_id)
+            items.append(msg_id)
+        
+        status_message = await client.send_message(user_id, f"🚀 Starting batch download of {len(items)} messages...")
+        progress = BatchProgress(status_message, len(items), skipped=len(msg_ids) - len(items))
+        refresher = asyncio.ensure_future(progress.refresh_loop())
+        
+        pending = list(items)
+        unfinished = set(items)
+        
+        async def worker():
+            while pending:
+                msg_id = pending.pop(0)
+                link = f"https://t.me/c/{chat}/{msg_id}" if is_private else f"https://t.me/{chat}/{msg_id}"
+                item_status = progress.item(msg_id)
+                # Registered as the user's task too, so /cancel reaches the transfer itself
+                await running_tasks.run(user_id, run_download(client, user_id, link, persist=False, status_msg=item_status, ctx=ctx))
+                progress.finish(item_status)
+                unfinished.discard(msg_id)
+                # Resume point: everything before the first unfinished item is done
+                await update_job_progress(job_id, min(unfinished, default=end_id + 1))
+        
+        from bot.transfer import gather_or_cancel
+        await gather_or_cancel([asyncio.ensure_future(worker()) for _ in range(min(BATCH_CONCURRENCY, len(items)))])
+        status = "done"
+        refresher.cancel()
+        await progress.refresh(final=True)
+    except asyncio.CancelledError:
+        if running_tasks.interrupted_by_shutdown():
+            # Leave the job running so it resumes after the restart
+            status = None
+            raise
+        status = "cancelled"
+        try:
+            await client.send_message(user_id, "❌ Batch cancelled by user.")
+        except Exception:
+            pass
+        raise
+    finally:
+        if refresher:
+            refresher.cancel()
+        await ctx.save()
+        if status:
+            await finish_job(job_id, status)
+
 @app.on_message(filters.regex(r"https://t\.me/") & filters.private)
 async def download_handler(client, message):
     user_id = message.from_user.id
@@ -202,8 +296,11 @@ async def download_handler(client, message):
         )
         return
 
-    allowed, msg_quota = await check_and_update_quota(user_id)
+    # Loaded once for the whole request: quota check, ad and download
+    ctx = await UserContext.load(user_id)
+    allowed, msg_quota = ctx.check_quota()
     if not allowed:
+        await ctx.save()
         await message.reply(
             f"⛔ {msg_quota}",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💎 Upgrade to Premium", callback_data="upgrade_prompt")]])
@@ -213,152 +310,93 @@ async def download_handler(client, message):
     # Show RichAds for free users
     try:
         from bot.ads import show_ad
-        await show_ad(client, user_id)
+        await show_ad(client, user_id, ctx=ctx)
     except Exception as e:
         print(f"Error showing RichAds: {e}")
 
-    if user_id in active_downloads:
-        await message.reply("⚠️ You already have a download in progress. Please wait.")
+    await running_tasks.run(user_id, run_download(client, user_id, message.text.strip(), reply_to=message, ctx=ctx))
+
+async def run_download(client, user_id, link, reply_to=None, job_id=None, skip=0, persist=True, status_msg=None, ctx=None, charged=0):
+    """Delivers the media behind a t.me link to the user; resumable through its jobs row (`job_id`, `skip`, `charged`)"""
+    async def reply(text, **kwargs):
+        if status_msg:
+            return await status_msg.edit_text(text, **kwargs)
+        if reply_to:
+            return await reply_to.reply(text, **kwargs)
+        return await client.send_message(user_id, text, **kwargs)
+
+    if ctx is None:
+        ctx = await UserContext.load(user_id)
+    is_premium = ctx.is_premium
+    job = scheduler.submit(user_id, is_premium)
+    if not job:
+        if is_premium:
+            await reply("⚠️ You already have the maximum number of downloads queued. Please wait.")
+        else:
+            await reply("⚠️ You already have a download in progress. Please wait.")
         return
 
-    active_downloads.add(user_id)
-    status_msg = await message.reply("🔍 Checking link...")
+    try:
+        status_msg = await reply("🔍 Checking link...")
+    except Exception:
+        scheduler.release(job)
+        raise
     
     user_client = None
-    path = None
+    led_flights = []
+    # What a cancel has to clean up: files being downloaded, and downloaded files not yet uploaded
+    downloading_media = set()
+    pending_files = set()
+    if persist and job_id is None:
+        job_id = await create_job(user_id, "link", {"link": link})
+    job_status = "failed"
+    # Files delivered so far (an interrupted attempt's included), and files of the job counted
+    # against the quota (delivered or reserved, by this attempt or an interrupted one)
+    downloaded_count = skip
     
-    if global_download_semaphore.locked():
-         await status_msg.edit_text("⚠️ Server busy. You are in the queue, please wait...")
-
-    await global_download_semaphore.acquire()
+    async def checkpoint(done):
+        await update_job_progress(job_id, done)
+    
+    async def show_queue_position(position, queued):
+        await status_msg.edit_text(f"⚠️ Server busy. You are **#{position}** of {queued} in the queue, please wait...")
+    job.on_position = show_queue_position
     
     try:
-        link = message.text.strip()
-        
-        import re
         chat_id = None
         message_id = None
         
-        public_match = re.search(r"t\.me/([^/]+)/(\d+)", link)
-        private_match = re.search(r"t\.me/c/(\d+)/(\d+)", link)
-        topic_match = re.search(r"t\.me/c/(\d+)/(\d+)/(\d+)", link)
-        comment_match = re.search(r"t\.me/([^/]+)/(\d+)\?comment=(\d+)", link)
-        private_comment_match = re.search(r"t\.me/c/(\d+)/(\d+)\?comment=(\d+)", link)
-        story_match = re.search(r"t\.me/([^/]+)/s/(\d+)", link)
-        private_story_match = re.search(r"t\.me/c/(\d+)/s/(\d+)", link)
-        single_match = re.search(r"t\.me/([^/]+)/(\d+)\?single", link)
-        private_single_match = re.search(r"t\.me/c/(\d+)/(\d+)\?single", link)
-        thread_match = re.search(r"t\.me/([^/]+)/(\d+)\?thread=(\d+)", link)
-        private_thread_match = re.search(r"t\.me/c/(\d+)/(\d+)\?thread=(\d+)", link)
-        
+        parsed = parse_link(link)
         is_private = False
         is_group = False
         is_story = False
-        if private_story_match:
-            chat_id = int("-100" + private_story_match.group(1))
-            message_id = int(private_story_match.group(2))
-            is_private = True
-            is_story = True
-        elif story_match:
-            chat_id = story_match.group(1)
-            message_id = int(story_match.group(2))
-            is_story = True
-        elif private_comment_match:
-            # We treat the comment as the target message
-            chat_id = int("-100" + private_comment_match.group(1))
-            message_id = int(private_comment_match.group(3))
-            is_private = True
-        elif comment_match:
-            chat_id = comment_match.group(1)
-            message_id = int(comment_match.group(3))
-        elif private_thread_match:
-            chat_id = int("-100" + private_thread_match.group(1))
-            message_id = int(private_thread_match.group(2)) # Thread link usually points to main post or thread id
-            is_private = True
-        elif thread_match:
-            chat_id = thread_match.group(1)
-            message_id = int(thread_match.group(2))
-        elif private_single_match:
-            chat_id = int("-100" + private_single_match.group(1))
-            message_id = int(private_single_match.group(2))
-            is_private = True
-        elif single_match:
-            chat_id = single_match.group(1)
-            message_id = int(single_match.group(2))
-        elif topic_match:
-            chat_id = int("-100" + topic_match.group(1))
-            message_id = int(topic_match.group(3))
-            is_private = True
-        elif private_match:
-            chat_id = int("-100" + private_match.group(1))
-            message_id = int(private_match.group(2))
-            is_private = True
-        elif public_match:
-            chat_id = public_match.group(1)
-            message_id = int(public_match.group(2))
-            # Programmatically check if it's a channel or group
+        if parsed:
+            chat_id = parsed.chat_id
+            message_id = parsed.message_id
+            is_private = parsed.is_private
+            is_story = parsed.is_story
+        if parsed and not is_private and not is_story:
+            # Programmatically check if it's a channel or group (cached, most links hit the same channels)
             try:
-                # Use a small timeout for get_chat to avoid hanging
-                chat = await asyncio.wait_for(client.get_chat(chat_id), timeout=10)
-                # In Pyrogram/Hydrogram, ChatType.CHANNEL is for broadcast channels
-                # ChatType.GROUP and ChatType.SUPERGROUP are for groups
-                chat_type_str = str(chat.type).lower()
-                if "group" in chat_type_str or chat.type in ["group", "supergroup"]:
-                    is_group = True
-                    print(f"[DEBUG] Detected as GROUP via type: {chat.type} for {chat_id}")
-                else:
-                    # Double check via broadcast attribute if available
-                    if hasattr(chat, "broadcast") and chat.broadcast is False:
-                         is_group = True
-                         print(f"[DEBUG] Detected as GROUP via broadcast=False for {chat_id}")
-                    else:
-                         print(f"[DEBUG] Detected as CHANNEL via type: {chat.type} for {chat_id}")
+                chat_info = await chat_info_cache.get(client, chat_id)
+                is_group = chat_info.is_group
+                logging.info(f"{chat_id} is a {chat_info.type}")
             except Exception as e:
                 print(f"Error checking chat type for {chat_id}: {e}")
 
-        user = await get_user(user_id)
-        
-        if (is_private or is_group) and (not user or not user.get('phone_session_string') or len(user.get('phone_session_string', '')) < 10):
+        if (is_private or is_group) and not ctx.session_string:
             msg_text = "❌ Login is mandatory for private channel links. Use /login to connect your account."
             if is_group:
                 msg_text = "❌ Login is mandatory for public group links to download media. Use /login to connect your account."
             await status_msg.edit_text(msg_text)
-            active_downloads.discard(user_id)
-            global_download_semaphore.release()
             return
 
-        # Handle user client session correctly with retry logic
+        # Reuse the user's warm session from the pool (connects with retries if there is none)
         if is_private or is_group or is_story:
-            session_str = user.get('phone_session_string') if user else None
-            if session_str and len(session_str) > 10:
-                max_retries = 3
-                for attempt in range(max_retries):
-                    try:
-                        user_client = Client(
-                            f"user_{user_id}_{int(time.time())}", 
-                            session_string=session_str, 
-                            in_memory=True, 
-                            api_id=API_ID, 
-                            api_hash=API_HASH,
-                            no_updates=True
-                        )
-                        await user_client.start()
-                        break
-                    except Exception as e:
-                        print(f"User client connection error (attempt {attempt + 1}/{max_retries}): {e}")
-                        if user_client:
-                            try:
-                                await user_client.stop()
-                            except:
-                                pass
-                        user_client = None
-                        if attempt < max_retries - 1:
-                            await asyncio.sleep(2)
+            if ctx.session_string:
+                user_client = await user_client_pool.acquire(user_id, ctx.session_string)
             
             if not user_client:
                 await status_msg.edit_text("❌ User session failed or not found. Please /login again.")
-                active_downloads.discard(user_id)
-                global_download_semaphore.release()
                 return
         else:
             user_client = client
@@ -372,18 +410,15 @@ async def download_handler(client, message):
                     # We must use the user_client (logged in user session) to fetch stories
                     if not user_client or user_client == client:
                          await status_msg.edit_text("❌ Login is mandatory for downloading stories. Use /login to connect your account.")
-                         active_downloads.discard(user_id)
-                         global_download_semaphore.release()
                          return
                     msg = await user_client.get_stories(chat_id, message_id)
                 else:
-                    msg = await user_client.get_messages(chat_id, message_id)
+                    # Coalesced with lookups other requests make on the same chat
+                    msg = await message_batcher.get(user_client, chat_id, message_id)
                 
                 if not msg:
                     print(f"[DEBUG] get_messages returned None for chat_id={chat_id}, message_id={message_id}")
                     await status_msg.edit_text("❌ Could not find message. Link might be invalid or expired.")
-                    active_downloads.discard(user_id)
-                    global_download_semaphore.release()
                     return
                 
                 messages_to_process = [msg]
@@ -400,61 +435,91 @@ async def download_handler(client, message):
                         print(f"[DEBUG] get_media_group failed: {e}, processing single message")
                         messages_to_process = [msg]
                 
-                remaining_quota, is_unlimited = await get_remaining_quota(user_id)
                 total_files = len(messages_to_process)
-                files_to_download = min(total_files, remaining_quota) if not is_unlimited else total_files
+                if skip and skip >= total_files:
+                    # Everything was delivered just before the interruption
+                    job_status = "done"
+                    await status_msg.delete()
+                    return
+                
+                # What an interrupted attempt charged (stored on the job) isn't charged again.
+                # The rest is reserved up front (atomically, so concurrent downloads can't overspend)
+                # and whatever isn't delivered is released at the end.
+                charged = max(charged, skip)
+                reserved, is_unlimited = await ctx.reserve_quota(max(0, total_files - charged))
+                charged += reserved
+                if reserved:
+                    await update_job_quota(job_id, charged)
+                files_to_download = min(charged, total_files)
                 quota_limited = files_to_download < total_files and not is_unlimited
                 
-                if files_to_download == 0:
+                if files_to_download <= skip:
                     await status_msg.edit_text(
-                        "⛔ Daily limit reached (5/5). Upgrade to Premium for unlimited downloads.",
+                        f"⛔ Daily limit reached ({FREE_DAILY_LIMIT}/{FREE_DAILY_LIMIT}). Upgrade to Premium for unlimited downloads.",
                         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💎 Upgrade to Premium", callback_data="upgrade_prompt")]])
                     )
-                    active_downloads.discard(user_id)
-                    global_download_semaphore.release()
                     return
                 
-                downloaded_count = 0
-                for idx, media_msg in enumerate(messages_to_process[:files_to_download]):
-                    from bot.config import cancel_flags
-                    if user_id in cancel_flags:
-                        await status_msg.edit_text("❌ Download cancelled by user.")
-                        cancel_flags.discard(user_id)
-                        active_downloads.discard(user_id)
-                        global_download_semaphore.release()
+                # Wait for a transfer slot; the expected size decides where the job queues
+                from bot.transfer import get_media, gather_or_cancel, upload_album_media, input_media_from_file_id, send_album
+                job_size = sum(
+                    getattr(get_media(m), "file_size", 0) or 0
+                    for m in messages_to_process[skip:files_to_download]
+                )
+                await scheduler.acquire(job, size=job_size)
+                
+                # Items are processed as a pipeline: the fetch stage downloads item N+1 while the
+                # deliver stage uploads item N. Anything that sends to the user waits for the previous
+                # item to be delivered first, so the album arrives in order.
+                depth = PREMIUM_PIPELINE_DEPTH if is_premium else PIPELINE_DEPTH
+                pipeline = asyncio.Queue(maxsize=depth)
+                delivered = {idx: asyncio.Event() for idx in range(skip, files_to_download)}
+                cache_chat = f"{chat_id}/s" if is_story else chat_id
+                
+                async def wait_turn(idx):
+                    if idx - 1 in delivered:
+                        await delivered[idx - 1].wait()
+                
+                # Albums are delivered in one go: every item is uploaded (or taken from the cache)
+                # first, then sent together with a single send_album call, so the user gets an
+                # album instead of separate messages
+                album_mode = is_media_group and not is_story and files_to_download - skip > 1
+                album = []
+                
+                async def dump_album(sent_msgs):
+                    dump_id = os.environ.get("DUMP_CHANNEL_ID")
+                    db_dump = await get_setting("dump_channel_id")
+                    if db_dump and db_dump.get('value'):
+                        dump_id = db_dump['value']
+                    if not dump_id or not sent_msgs:
                         return
-
+                    try:
+                        dump_id_int = int(dump_id)
+                        captions = [m.caption or "" for m in sent_msgs]
+                        captions[0] = f"From User: `{user_id}`\nLink: {link}\n\n{captions[0]}".strip()
+                        # Albums of more than 10 items (or ones that fell back to single sends) arrive as several groups
+                        groups = {}
+                        for sent, caption in zip(sent_msgs, captions):
+                            groups.setdefault(sent.media_group_id or f"single_{sent.id}", []).append((sent, caption))
+                        for group in groups.values():
+                            if len(group) > 1:
+                                await client.copy_media_group(dump_id_int, user_id, group[0][0].id, captions=[c for _, c in group])
+                            else:
+                                await group[0][0].copy(dump_id_int, caption=group[0][1])
+                    except Exception as e:
+                        print(f"Dump failed: {e}")
+                
+                async def fetch_item(idx, media_msg):
+                    nonlocal downloaded_count
+                    item = {"idx": idx, "msg": media_msg, "path": None, "sent_msg": None, "flight": None, "source_media": None, "input_media": None}
+                    
                     if not media_msg.media:
-                        if media_msg.text:
-                            # Handle text-only messages
-                            try:
-                                sent_msg = await client.send_message(
-                                    user_id,
-                                    media_msg.text,
-                                    entities=media_msg.entities
-                                )
-                                downloaded_count += 1
-                                # Handle dumping for text messages
-                                dump_id = os.environ.get("DUMP_CHANNEL_ID")
-                                db_dump = await get_setting("dump_channel_id")
-                                if db_dump and db_dump.get('value'):
-                                    dump_id = db_dump['value']
-                                if dump_id and sent_msg:
-                                    try:
-                                        dump_id_int = int(dump_id)
-                                        original_text = media_msg.text or ""
-                                        dump_caption = f"From User: `{user_id}`\nLink: {link}\n\n{original_text}".strip()
-                                        await sent_msg.copy(dump_id_int, caption=dump_caption)
-                                    except:
-                                        pass
-                            except Exception as e:
-                                print(f"Error sending text message: {e}")
-                        continue
+                        return item
                     
                     current_status = f"📥 Downloading file {idx + 1}/{files_to_download}..." if files_to_download > 1 else "📥 Downloading..."
                     try:
                         await status_msg.edit_text(current_status)
-                    except:
+                    except Exception:
                         pass
                     
                     path = None
@@ -471,10 +536,38 @@ async def download_handler(client, message):
                         elif media_msg.audio: file_size = media_msg.audio.file_size
                         elif media_msg.photo: file_size = media_msg.photo.file_size
 
-                    # Force disk download for everything to save RAM on 1.5GB VPS
-                    use_memory = False
+                    # Someone already got this file from us: resend our copy by file_id
+                    source_media = item["source_media"] = get_media(media_msg)
+                    cached = await get_cached_media(cache_chat, media_msg.id, source_media.file_unique_id) if source_media else None
+                    if cached and album_mode:
+                        try:
+                            item["input_media"] = input_media_from_file_id(cached["file_id"])
+                            path = "CACHED"
+                        except Exception as e:
+                            logging.warning(f"Cached file_id unusable: {e}, invalidating")
+                            await invalidate_cached_media(cache_chat, media_msg.id)
+                    elif cached:
+                        await wait_turn(idx)
+                        try:
+                            sent_msg = await client.send_cached_media(
+                                user_id,
+                                cached["file_id"],
+                                caption=media_msg.caption or None
+                            )
+                            if sent_msg:
+                                path = "CACHED"
+                                downloaded_count += 1
+                        except BadRequest as e:
+                            # Stale file reference or deleted file: forget it and transfer again
+                            logging.warning(f"Cached media rejected: {e}, invalidating")
+                            await invalidate_cached_media(cache_chat, media_msg.id)
+                        except Exception as e:
+                            logging.warning(f"send_cached_media failed: {e}, falling back to transfer")
 
-                    if not is_group and user_client == client and isinstance(chat_id, (str, int)):
+                    # Chats known to refuse copies (content protection) go straight to the transfer
+                    if not path and not album_mode and not is_group and user_client == client and isinstance(chat_id, (str, int)) \
+                            and chat_info_cache.can_copy(chat_id) is not False:
+                        await wait_turn(idx)
                         try:
                             # Direct copy is fastest for public links (channels)
                             sent = await client.copy_message(
@@ -488,57 +581,203 @@ async def download_handler(client, message):
                                 downloaded_count += 1
                         except Exception as e:
                             print(f"[DEBUG] copy_message failed: {e}, falling back to download")
-                    
-                    if not path:
-                        if use_memory:
-                            # Use default Pyrogram download for small files
-                            path = await user_client.download_media(media_msg, in_memory=True)
+                            # Only content protection applies to the whole chat; other errors just skip the copy for this item
+                            if isinstance(e, ChatForwardsRestricted):
+                                await chat_info_cache.record_copy_refused(chat_id)
+
+                    # Identical request already transferring for someone else: wait for it instead
+                    flight = None
+                    progress_cb = progress_bar
+                    if not path and source_media:
+                        flight_key = (str(cache_chat).lower(), media_msg.id, source_media.file_unique_id)
+                        flight, is_leader = transfer_flights.join(flight_key)
+                        if is_leader:
+                            led_flights.append(flight)
+                            progress_cb = flight.progress
                         else:
-                            from bot.transfer import download_media_fast, upload_media_fast
-                            # Get proper file extension from document or other media
-                            ext = ""
-                            if not is_story:
-                                if media_msg.document:
-                                    if media_msg.document.file_name:
-                                        _, ext = os.path.splitext(media_msg.document.file_name)
-                                elif media_msg.audio:
-                                    if media_msg.audio.file_name:
-                                        _, ext = os.path.splitext(media_msg.audio.file_name)
-                                    if not ext:
-                                        ext = ".mp3"
-                                elif media_msg.photo:
-                                    ext = ".jpg"
-                                elif media_msg.voice:
-                                    ext = ".ogg"
-                                elif media_msg.video:
-                                    if media_msg.video.file_name:
-                                        _, ext = os.path.splitext(media_msg.video.file_name)
-                                    else:
-                                        ext = ".mp4"
-                            
-                            # Fallback to default if no extension found
-                            file_suffix = f"_{media_msg.id}{ext}"
-                            
-                            # Optimized fast transfer for larger files
+                            try:
+                                await status_msg.edit_text(f"⏳ This file is already being transferred, joining it ({idx + 1}/{files_to_download})...")
+                            except Exception:
+                                pass
+                            # Waiting doesn't use a transfer slot, give it to someone else meanwhile
+                            scheduler.suspend(job)
+                            shared_file_id = await flight.wait(status_msg)
+                            await scheduler.resume(job)
+                            flight = None
+                            if shared_file_id and album_mode:
+                                item["input_media"] = input_media_from_file_id(shared_file_id)
+                                path = "CACHED"
+                            elif shared_file_id:
+                                await wait_turn(idx)
+                                try:
+                                    sent_msg = await client.send_cached_media(
+                                        user_id,
+                                        shared_file_id,
+                                        caption=media_msg.caption or None
+                                    )
+                                    if sent_msg:
+                                        path = "CACHED"
+                                        downloaded_count += 1
+                                except Exception as e:
+                                    logging.warning(f"Shared transfer result rejected: {e}, transferring again")
+                    item["flight"] = flight
+
+                    # Stream the file straight from the source DC into the upload (no disk).
+                    # Very large files take the resumable disk path so a failure doesn't restart them from zero.
+                    if not path and STREAM_RELAY and not album_mode and 0 < file_size < RESUMABLE_MIN_SIZE and not media_msg.photo:
+                        from bot.transfer import relay_media, CdnRedirect
+                        relay_kwargs = {}
+                        if media_msg.video:
+                            thumb = None
+                            try:
+                                if media_msg.video.thumbs:
+                                    thumb = await user_client.download_media(media_msg.video.thumbs[0].file_id, in_memory=True)
+                            except Exception as e:
+                                logging.warning(f"Thumbnail download failed: {e}")
+                            relay_kwargs = dict(
+                                duration=media_msg.video.duration or 0,
+                                width=media_msg.video.width or 0,
+                                height=media_msg.video.height or 0,
+                                thumb=thumb,
+                                supports_streaming=True
+                            )
+
+                        await wait_turn(idx)
+                        await global_upload_semaphore.acquire()
+                        try:
+                            try:
+                                await status_msg.edit_text(f"🔁 Transferring file {idx + 1}/{files_to_download}...")
+                            except Exception:
+                                pass
+                            sent_msg = await asyncio.wait_for(
+                                relay_media(
+                                    client,
+                                    user_client,
+                                    media_msg,
+                                    user_id,
+                                    caption=media_msg.caption or None,
+                                    progress_callback=progress_cb,
+                                    progress_args=(status_msg, f"🔁 Transferring {idx + 1}/{files_to_download}"),
+                                    **relay_kwargs
+                                ),
+                                timeout=1200
+                            )
+                            path = "RELAYED"
+                            downloaded_count += 1
+                        except CdnRedirect:
+                            logging.info("File is served from CDN, falling back to disk download")
+                        except Exception as e:
+                            # Expired file reference, timeout, worker error...: the disk path may still work
+                            logging.warning(f"Relay failed: {e}, falling back to disk download")
+                            if isinstance(e, FileReferenceExpired) and not is_story:
+                                try:
+                                    media_msg = item["msg"] = await user_client.get_messages(chat_id, media_msg.id)
+                                except Exception as e:
+                                    logging.warning(f"Could not refresh the file reference: {e}")
+                        finally:
+                            global_upload_semaphore.release()
+
+                    if not path:
+                        from bot.transfer import download_media_fast
+                        # Get proper file extension from document or other media
+                        ext = ""
+                        if not is_story:
+                            if media_msg.document:
+                                if media_msg.document.file_name:
+                                    _, ext = os.path.splitext(media_msg.document.file_name)
+                            elif media_msg.audio:
+                                if media_msg.audio.file_name:
+                                    _, ext = os.path.splitext(media_msg.audio.file_name)
+                                if not ext:
+                                    ext = ".mp3"
+                            elif media_msg.photo:
+                                ext = ".jpg"
+                            elif media_msg.voice:
+                                ext = ".ogg"
+                            elif media_msg.video:
+                                if media_msg.video.file_name:
+                                    _, ext = os.path.splitext(media_msg.video.file_name)
+                                else:
+                                    ext = ".mp4"
+                        
+                        # Fallback to default if no extension found
+                        file_suffix = f"_{media_msg.id}{ext}"
+                        
+                        # Force disk download for everything to save RAM on 1.5GB VPS
+                        # Optimized fast transfer for larger files
+                        if source_media:
+                            downloading_media.add(source_media.file_unique_id)
+                        try:
                             path = await asyncio.wait_for(
                                 download_media_fast(
                                     user_client,
                                     media_msg,
                                     f"downloads/{user_id}{file_suffix}",
-                                    progress_callback=progress_bar,
+                                    progress_callback=progress_cb,
                                     progress_args=(status_msg, f"📥 Downloading {idx + 1}/{files_to_download}")
                                 ),
                                 timeout=1200
                             )
+                        except Exception:
+                            # A cancel (CancelledError) keeps the entry, so the cancel handler discards the partial
+                            if source_media:
+                                downloading_media.discard(source_media.file_unique_id)
+                            raise
+                        if source_media:
+                            downloading_media.discard(source_media.file_unique_id)
+                        if isinstance(path, str):
+                            pending_files.add(path)
+                    
+                    item["path"] = path
+                    item["sent_msg"] = sent_msg
+                    return item
+                
+                async def deliver_item(item):
+                    nonlocal downloaded_count
+                    idx = item["idx"]
+                    media_msg = item["msg"]
+                    path = item["path"]
+                    sent_msg = item["sent_msg"]
+                    flight = item["flight"]
+                    source_media = item["source_media"]
+                    progress_cb = flight.progress if flight else progress_bar
+                    
+                    if not media_msg.media:
+                        if media_msg.text:
+                            # Handle text-only messages
+                            try:
+                                sent_msg = await client.send_message(
+                                    user_id,
+                                    media_msg.text,
+                                    entities=media_msg.entities
+                                )
+                                downloaded_count += 1
+                                # Handle dumping for text messages
+                                dump_id = os.environ.get("DUMP_CHANNEL_ID")
+                                db_dump = await get_setting("dump_channel_id")
+                                if db_dump and db_dump.get('value'):
+                                    dump_id = db_dump['value']
+                                if dump_id and sent_msg:
+                                    try:
+                                        dump_id_int = int(dump_id)
+                                        original_text = media_msg.text or ""
+                                        dump_caption = f"From User: `{user_id}`\nLink: {link}\n\n{original_text}".strip()
+                                        await sent_msg.copy(dump_id_int, caption=dump_caption)
+                                    except Exception:
+                                        pass
+                            except Exception as e:
+                                print(f"Error sending text message: {e}")
+                        await checkpoint(idx + 1)
+                        return
                     
-                    if path and path != "COPIED":
+                    if path and path not in ("COPIED", "RELAYED", "CACHED"):
+                        from bot.transfer import upload_media_fast
                         caption = media_msg.caption if media_msg.caption else None
                         
                         try:
-                            from bot.config import global_upload_semaphore
                             await global_upload_semaphore.acquire()
                             await status_msg.edit_text(f"📤 Uploading file {idx + 1}/{files_to_download}...")
-                        except:
+                        except Exception:
                             pass
                         
                         try:
@@ -554,7 +793,7 @@ async def download_handler(client, message):
                                     try:
                                         if msg.video.thumbs:
                                             thumb_path = await user_client.download_media(msg.video.thumbs[0].file_id)
-                                    except: pass
+                                    except Exception: pass
                                     
                                     sent_msg = await client.send_video(
                                         user_id,
@@ -568,30 +807,22 @@ async def download_handler(client, message):
                                     )
                                     if thumb_path and os.path.exists(thumb_path):
                                         try: os.remove(thumb_path)
-                                        except: pass
+                                        except Exception: pass
                             elif media_msg.photo:
-                                if use_memory:
-                                    sent_msg = await client.send_photo(user_id, path, caption=caption)
-                                else:
-                                    # Photos can be uploaded via send_document for fast logic if needed, 
-                                    # but standard photo upload is usually fast enough. 
-                                    # For consistency, we'll keep standard for tiny files and use fast for big ones.
-                                    sent_msg = await client.send_photo(
-                                        user_id,
-                                        path,
-                                        caption=caption,
-                                        progress=progress_bar,
-                                        progress_args=(status_msg, f"📤 Uploading {idx + 1}/{files_to_download}")
-                                    )
+                                # Standard photo upload is fast enough for photos
+                                sent_msg = await client.send_photo(
+                                    user_id,
+                                    path,
+                                    caption=caption,
+                                    progress=progress_cb,
+                                    progress_args=(status_msg, f"📤 Uploading {idx + 1}/{files_to_download}")
+                                )
                             elif media_msg.audio:
-                                if use_memory:
-                                    sent_msg = await client.send_audio(user_id, path, caption=caption)
-                                else:
-                                    loop = asyncio.get_event_loop()
-                                    sent_msg = await upload_media_fast(
-                                        client, user_id, path, caption=caption, 
-                                        progress_callback=lambda c, t: loop.create_task(progress_bar(c, t, status_msg, f"📤 Uploading {idx + 1}/{files_to_download}"))
-                                    )
+                                loop = asyncio.get_event_loop()
+                                sent_msg = await upload_media_fast(
+                                    client, user_id, path, caption=caption, 
+                                    progress_callback=lambda c, t: loop.create_task(progress_cb(c, t, status_msg, f"📤 Uploading {idx + 1}/{files_to_download}"))
+                                )
                             elif media_msg.video:
                                 thumb_path = None
                                 try:
@@ -610,34 +841,48 @@ async def download_handler(client, message):
                                     height=media_msg.video.height or 0,
                                     thumb=thumb_path,
                                     supports_streaming=True,
-                                    progress_callback=lambda c, t: loop.create_task(progress_bar(c, t, status_msg, f"📤 Uploading {idx + 1}/{files_to_download}"))
+                                    progress_callback=lambda c, t: loop.create_task(progress_cb(c, t, status_msg, f"📤 Uploading {idx + 1}/{files_to_download}"))
                                 )
                                 
                                 if thumb_path and isinstance(thumb_path, str) and os.path.exists(thumb_path):
                                     try: os.remove(thumb_path)
-                                    except: pass
+                                    except Exception: pass
                             else:
-                                if use_memory:
-                                    sent_msg = await client.send_document(user_id, path, caption=caption)
-                                else:
-                                    loop = asyncio.get_event_loop()
-                                    sent_msg = await upload_media_fast(
-                                        client, user_id, path, caption=caption,
-                                        progress_callback=lambda c, t: loop.create_task(progress_bar(c, t, status_msg, f"📤 Uploading {idx + 1}/{files_to_download}"))
-                                    )
+                                loop = asyncio.get_event_loop()
+                                sent_msg = await upload_media_fast(
+                                    client, user_id, path, caption=caption,
+                                    progress_callback=lambda c, t: loop.create_task(progress_cb(c, t, status_msg, f"📤 Uploading {idx + 1}/{files_to_download}"))
+                                )
                         finally:
-                            from bot.config import global_upload_semaphore
                             global_upload_semaphore.release()
                         
                         downloaded_count += 1
                         
-                        # Clean up file only if it's a file path, not BytesIO
-                        if not use_memory and path and isinstance(path, str) and os.path.exists(path):
+                        # Clean up the downloaded file
+                        pending_files.discard(path)
+                        if isinstance(path, str) and os.path.exists(path):
                             try:
                                 os.remove(path)
-                            except:
+                            except Exception:
                                 pass
                     
+                    # Remember our upload so the next request for this post skips the transfer
+                    if source_media and sent_msg and path not in ("COPIED", "CACHED"):
+                        sent_media = get_media(sent_msg)
+                        if sent_media:
+                            if flight:
+                                transfer_flights.finish(flight, sent_media.file_id)
+                            await save_cached_media(
+                                cache_chat,
+                                media_msg.id,
+                                source_media.file_unique_id,
+                                sent_media.file_id,
+                                sent_msg.media.value if sent_msg.media else None
+                            )
+                    
+                    if flight:
+                        transfer_flights.finish(flight, None)
+                    
                     dump_id = os.environ.get("DUMP_CHANNEL_ID")
                     db_dump = await get_setting("dump_channel_id")
                     if db_dump and db_dump.get('value'):
@@ -651,8 +896,146 @@ async def download_handler(client, message):
                             await sent_msg.copy(dump_id_int, caption=dump_caption)
                         except Exception as e:
                             print(f"Dump failed: {e}")
+                    
+                    await checkpoint(idx + 1)
+                
+                async def stage_album_item(item):
+                    idx = item["idx"]
+                    media_msg = item["msg"]
+                    path = item["path"]
+                    flight = item["flight"]
+                    progress_cb = flight.progress if flight else progress_bar
+                    input_media = item["input_media"]
+                    
+                    if path and path != "CACHED":
+                        upload_kwargs = {}
+                        thumb_path = None
+                        if media_msg.video:
+                            try:
+                                if media_msg.video.thumbs:
+                                    thumb_path = await user_client.download_media(media_msg.video.thumbs[0].file_id)
+                            except Exception as e:
+                                logging.warning(f"Thumbnail download failed: {e}")
+                            upload_kwargs = dict(
+                                duration=media_msg.video.duration or 0,
+                                width=media_msg.video.width or 0,
+                                height=media_msg.video.height or 0,
+                                thumb=thumb_path,
+                                supports_streaming=True
+                            )
+                        
+                        await global_upload_semaphore.acquire()
+                        try:
+                            try:
+                                await status_msg.edit_text(f"📤 Uploading file {idx + 1}/{files_to_download}...")
+                            except Exception:
+                                pass
+                            loop = asyncio.get_event_loop()
+                            input_media = await upload_album_media(
+                                client, user_id, path,
+                                progress_callback=lambda c, t: loop.create_task(progress_cb(c, t, status_msg, f"📤 Uploading {idx + 1}/{files_to_download}")),
+                                **upload_kwargs
+                            )
+                        finally:
+                            global_upload_semaphore.release()
+                            if thumb_path and isinstance(thumb_path, str) and os.path.exists(thumb_path):
+                                try: os.remove(thumb_path)
+                                except Exception: pass
+                        
+                        pending_files.discard(path)
+                        if isinstance(path, str) and os.path.exists(path):
+                            try:
+                                os.remove(path)
+                            except Exception:
+                                pass
+                    
+                    if input_media:
+                        album.append((input_media, media_msg.caption or None, item))
+                
+                async def deliver_album():
+                    nonlocal downloaded_count
+                    sent_msgs = []
+                    retried = set()
+                    pending = list(album)
+                    while pending:
+                        try:
+                            await status_msg.edit_text(f"📤 Sending album ({len(pending)} files)...")
+                        except Exception:
+                            pass
+                        results = await send_album(client, user_id, [(media, caption) for media, caption, _ in pending])
+                        retry = []
+                        for (_, _, item), sent_msg in zip(pending, results):
+                            if sent_msg is None:
+                                if item["path"] != "CACHED" or item["idx"] in retried:
+                                    raise RuntimeError(f"Telegram rejected file {item['idx'] + 1} of the album")
+                                retry.append(item)
+                                continue
+                            downloaded_count += 1
+                            sent_msgs.append(sent_msg)
+                            source_media = item["source_media"]
+                            flight = item["flight"]
+                            sent_media = get_media(sent_msg)
+                            if source_media and sent_media and item["path"] != "CACHED":
+                                if flight:
+                                    transfer_flights.finish(flight, sent_media.file_id)
+                                await save_cached_media(
+                                    cache_chat,
+                                    item["msg"].id,
+                                    source_media.file_unique_id,
+                                    sent_media.file_id,
+                                    sent_msg.media.value if sent_msg.media else None
+                                )
+                            if flight:
+                                transfer_flights.finish(flight, None)
+                        # Stale file reference or deleted file: forget the cached copy and transfer again
+                        album.clear()
+                        for item in retry:
+                            logging.warning(f"Cached album item {item['idx'] + 1} rejected, invalidating")
+                            retried.add(item["idx"])
+                            await invalidate_cached_media(cache_chat, item["msg"].id)
+                            await stage_album_item(await fetch_item(item["idx"], item["msg"]))
+                        pending = list(album)
+                    await dump_album(sent_msgs)
+                
+                async def fetch_stage():
+                    for idx, media_msg in enumerate(messages_to_process[:files_to_download]):
+                        if idx < skip:
+                            continue
+                        await pipeline.put(await fetch_item(idx, media_msg))
+                    await pipeline.put(None)
+                
+                async def deliver_stage():
+                    while True:
+                        item = await pipeline.get()
+                        if item is None:
+                            return
+                        if album_mode:
+                            await stage_album_item(item)
+                        else:
+                            await deliver_item(item)
+                        delivered[item["idx"]].set()
                 
-                await increment_quota(user_id, downloaded_count)
+                # A public album the bot can read is copied whole with one request
+                copied_album = None
+                if album_mode and not is_group and user_client == client and skip == 0 and files_to_download == total_files \
+                        and chat_info_cache.can_copy(chat_id) is not False:
+                    try:
+                        copied_album = await client.copy_media_group(user_id, chat_id, message_id)
+                    except Exception as e:
+                        logging.warning(f"copy_media_group failed: {e}, transferring the album")
+                        if isinstance(e, ChatForwardsRestricted):
+                            await chat_info_cache.record_copy_refused(chat_id)
+                
+                if copied_album:
+                    downloaded_count += len(copied_album)
+                    await dump_album(copied_album)
+                else:
+                    await gather_or_cancel([asyncio.ensure_future(fetch_stage()), asyncio.ensure_future(deliver_stage())])
+                    if album:
+                        await deliver_album()
+                
+                await checkpoint(files_to_download)
+                job_status = "done"
                 
                 if quota_limited:
                     skipped = total_files - files_to_download
@@ -669,26 +1052,53 @@ async def download_handler(client, message):
                 print(f"[DEBUG] Media processing failed: {str(e)}")
                 try:
                     await status_msg.edit_text(f"❌ Error: {str(e)}")
-                except:
+                except Exception:
                     pass
         else:
             await status_msg.edit_text("❌ Invalid link format. Could not extract chat ID or message ID.")
             
+    except asyncio.CancelledError:
+        # Free the slot before any cleanup I/O, so the next job starts right away
+        scheduler.release(job)
+        if running_tasks.interrupted_by_shutdown():
+            # Leave the job running so it resumes after the restart
+            job_status = None
+            raise
+        job_status = "cancelled"
+        from bot.transfer import discard_partial_download
+        if user_client:
+            for file_unique_id in downloading_media:
+                discard_partial_download(user_client, file_unique_id)
+        for path in pending_files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        try:
+            await status_msg.edit_text("❌ Download cancelled by user.")
+        except Exception:
+            pass
+        raise
     except Exception as e:
         print(f"Global download handler error: {e}")
         try:
             if "Error:" not in status_msg.text:
                 await status_msg.edit_text(f"❌ Error: {str(e)}")
-        except:
+        except Exception:
             pass
     finally:
-        active_downloads.discard(user_id)
-        global_download_semaphore.release()
+        # Waiters of a transfer we led but didn't finish fall back to their own transfer
+        for flight in led_flights:
+            transfer_flights.finish(flight, None)
+        scheduler.release(job)
+        # A job that resumes after the restart keeps its reservation
+        if job_status or not job_id:
+            await ctx.release_quota(charged - downloaded_count)
+        await ctx.save()
+        if job_status:
+            await finish_job(job_id, job_status)
         if user_client and user_client != client:
-            try:
-                await user_client.stop()
-            except:
-                pass
+            await user_client_pool.release(user_id, user_client)
 
 @app.on_callback_query(filters.regex("upgrade_prompt"))
 async def upgrade_prompt_callback(client, callback_query):
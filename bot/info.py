@@ -1,18 +1,22 @@
 from pyrogram import filters
-from bot.config import app
-from bot.database import get_user, check_and_update_quota
+from bot.config import app, FREE_DAILY_LIMIT
+from bot.user_context import UserContext
 
 @app.on_message(filters.command("myinfo") & filters.private)
 async def myinfo(client, message):
     user_id = message.from_user.id
-    user = await get_user(user_id)
-    if not user:
+    ctx = await UserContext.load(user_id)
+    if not ctx.exists:
         await message.reply("User not found. /start first.")
         return
-        
-    role_raw = user.get('role', 'free')
+    user = ctx.user
+    
+    # Applies the day rollover and premium expiry the download path would
+    ctx.check_quota()
+    await ctx.save()
+    role_raw = ctx.role or 'free'
     role = role_raw.upper()
-    quota_info = "Unlimited" if role_raw in ['premium', 'admin', 'owner'] else f"{user.get('downloads_today', 0)}/5"
+    quota_info = "Unlimited" if ctx.is_premium else f"{ctx.downloads_today}/{FREE_DAILY_LIMIT}"
     
     expiry_info = ""
     if role_raw == 'premium' and user.get('premium_expiry_date'):
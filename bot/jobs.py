@@ -0,0 +1,55 @@
+import asyncio
+import logging
+from bot.database import claim_job, finish_job
+
+logger = logging.getLogger(__name__)
+
+# How often the worker looks for queued jobs
+POLL_INTERVAL = 10
+
+async def run_job(client, job):
+    """Resumes a job from its jobs row: a single link or a /batch range"""
+    from bot.handlers import run_download, run_batch
+    from bot.task_registry import running_tasks
+    from bot.user_context import UserContext
+    user_id = int(job["telegram_id"])
+    payload = job["payload"]
+    try:
+        if job["kind"] == "batch":
+            # Batches are for premium users; the role may have expired since the batch started
+            ctx = await UserContext.load(user_id)
+            allowed, _ = ctx.check_quota()
+            await ctx.save()
+            if not allowed or not ctx.is_premium:
+                await finish_job(job["id"], "failed", "no longer allowed to batch")
+                await client.send_message(user_id, "⛔ Your batch download was stopped by a restart and can't resume: batch download is for **Premium** users only. Use /upgrade to level up!")
+                return
+            await client.send_message(user_id, "♻️ The bot restarted, resuming your batch download...")
+            await running_tasks.run(user_id, run_batch(
+                client, user_id, payload["chat"], payload["start_id"], payload["end_id"], payload["private"],
+                job_id=job["id"], next_id=job["progress"] or None
+            ))
+        else:
+            await client.send_message(user_id, f"♻️ The bot restarted, resuming your download:\n{payload['link']}")
+            await running_tasks.run(user_id, run_download(
+                client, user_id, payload["link"], job_id=job["id"], skip=job["progress"], charged=job.get("quota_charged") or 0
+            ))
+    except Exception as e:
+        logger.error(f"Job {job['id']} failed: {e}")
+        await finish_job(job["id"], "failed", str(e))
+
+async def job_worker_loop(client):
+    """Claims queued jobs (requeued at startup by requeue_interrupted_jobs) and runs them"""
+    while not client.is_initialized:
+        await asyncio.sleep(1)
+
+    while True:
+        try:
+            job = await claim_job()
+            while job:
+                logger.info(f"Resuming {job['kind']} job {job['id']} of user {job['telegram_id']} (attempt {job['attempts']})")
+                asyncio.create_task(run_job(client, job))
+                job = await claim_job()
+        except Exception as e:
+            logger.error(f"Job worker error: {e}")
+        await asyncio.sleep(POLL_INTERVAL)
@@ -0,0 +1,74 @@
+import re
+
+# One pattern for every t.me message link we accept:
+#   t.me/<username>/<id>            public post
+#   t.me/c/<internal id>/<id>       private post
+#   t.me/.../<topic id>/<id>        post inside a forum topic
+#   t.me/.../s/<id>                 story
+# followed by an optional query (?comment=<id>, ?thread=<id>, ?single)
+LINK_PATTERN = re.compile(
+    r"t\.me/"
+    r"(?:c/(?P<internal>\d+)|(?!c/)(?P<username>[A-Za-z0-9_]+))/"
+    r"(?:s/(?P<story>\d+)|(?P<first>\d+)(?:/(?P<second>\d+))?)"
+    r"(?:\?(?P<query>[^\s#]*))?"
+)
+QUERY_PATTERN = re.compile(r"(?:^|&)(comment|thread|single)(?:=(\d*))?")
+
+class ParsedLink:
+    """
+    A t.me message link. `kind` is one of public, private, topic, comment, story, single or
+    thread; `chat` is the username or the internal id as written in the link, `chat_id` what
+    to pass to pyrogram (the username, or -100<internal id> for private links).
+    """
+    __slots__ = ("kind", "chat", "chat_id", "message_id", "is_private", "thread_id")
+
+    def __init__(self, kind, chat, message_id, is_private, thread_id=None):
+        self.kind = kind
+        self.chat = chat
+        self.chat_id = int("-100" + chat) if is_private else chat
+        self.message_id = message_id
+        self.is_private = is_private
+        self.thread_id = thread_id
+
+    @property
+    def is_story(self):
+        return self.kind == "story"
+
+    def __eq__(self, other):
+        return isinstance(other, ParsedLink) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __repr__(self):
+        return f"ParsedLink({self.kind!r}, {self.chat_id!r}, {self.message_id})"
+
+def parse_link(text):
+    """Parses the first t.me message link in `text`. Returns a ParsedLink, or None if there is none."""
+    match = LINK_PATTERN.search(text or "")
+    if not match:
+        return None
+    internal, username, story, first, second, query = match.group(
+        "internal", "username", "story", "first", "second", "query"
+    )
+    is_private = internal is not None
+    chat = internal if is_private else username
+
+    if story:
+        return ParsedLink("story", chat, int(story), is_private)
+
+    # In a topic link the first number is the topic, the second the post
+    kind = "topic" if second else ("private" if is_private else "public")
+    message_id = int(second or first)
+    thread_id = int(first) if second else None
+
+    if query:
+        params = {name: value for name, value in QUERY_PATTERN.findall(query)}
+        if params.get("comment"):
+            # The comment itself is the message we want
+            return ParsedLink("comment", chat, int(params["comment"]), is_private, thread_id=message_id)
+        if "thread" in params:
+            return ParsedLink("thread", chat, message_id, is_private, thread_id=int(params["thread"] or 0) or thread_id)
+        if "single" in params:
+            return ParsedLink("single", chat, message_id, is_private, thread_id=thread_id)
+
+    return ParsedLink(kind, chat, message_id, is_private, thread_id=thread_id)
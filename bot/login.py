@@ -5,6 +5,8 @@ from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from pyrogram.errors import SessionPasswordNeeded, PhoneCodeInvalid, PasswordHashInvalid
 from bot.config import app, login_states, API_ID, API_HASH
 from bot.database import get_user, create_user, update_user_terms, save_session_string, logout_user
+from bot.client_pool import user_client_pool
+from bot.links import parse_link
 
 @app.on_message(filters.command("start") & filters.private)
 async def start(client, message):
@@ -156,27 +158,15 @@ async def batch_command(client, message):
         start_link = parts[1]
         end_link = parts[2]
         
-        import re
-        start_link = start_link.split('?')[0]
-        end_link = end_link.split('?')[0]
-        start_match = re.search(r"t\.me/([^/]+)/(\d+)", start_link)
-        if "t.me/c/" in start_link:
-            start_match = re.search(r"t\.me/c/(\d+)/(\d+)", start_link)
+        start = parse_link(start_link)
+        end = parse_link(end_link)
         
-        end_match = re.search(r"t\.me/([^/]+)/(\d+)", end_link)
-        if "t.me/c/" in end_link:
-            end_match = re.search(r"t\.me/c/(\d+)/(\d+)", end_link)
-        
-        if not start_match or not end_match:
+        if not start or not end or start.is_story or end.is_story or start.chat_id != end.chat_id:
             await message.reply("❌ Invalid links provided.")
             return
             
-        chat_id = start_match.group(1)
-        if "t.me/c/" in start_link:
-            chat_id = int("-100" + chat_id)
-            
-        start_id = int(start_match.group(2))
-        end_id = int(end_match.group(2))
+        start_id = start.message_id
+        end_id = end.message_id
         
         if start_id > end_id:
             start_id, end_id = end_id, start_id
@@ -186,49 +176,11 @@ async def batch_command(client, message):
             await message.reply("⚠️ You can only batch up to 50 messages at a time.")
             return
             
-        await message.reply(f"🚀 Starting batch download of {count} messages...")
-        
         # Import here to avoid circular import if needed
-        from bot.handlers import download_handler
+        from bot.handlers import run_batch
+        from bot.task_registry import running_tasks
         
-        processed_media_groups = set()
-        
-        for msg_id in range(start_id, end_id + 1):
-            mock_message = message
-            mock_message.text = f"https://t.me/{start_match.group(1)}/{msg_id}"
-            if "t.me/c/" in start_link:
-                 mock_message.text = f"https://t.me/c/{start_match.group(1)}/{msg_id}"
-            
-            # Fetch message to check for media group
-            try:
-                user = await get_user(user_id)
-                session_str = user.get('phone_session_string')
-                
-                # Use user client if private link, else main client
-                if "t.me/c/" in start_link and session_str:
-                    temp_client = Client(
-                        f"peek_{user_id}_{int(time.time())}",
-                        session_string=session_str,
-                        in_memory=True,
-                        api_id=API_ID,
-                        api_hash=API_HASH,
-                        no_updates=True
-                    )
-                    await temp_client.start()
-                    m = await temp_client.get_messages(chat_id, msg_id)
-                    await temp_client.stop()
-                else:
-                    m = await client.get_messages(chat_id, msg_id)
-
-                if m and m.media_group_id:
-                    if m.media_group_id in processed_media_groups:
-                        continue
-                    processed_media_groups.add(m.media_group_id)
-            except:
-                pass
-
-            await download_handler(client, mock_message)
-            await asyncio.sleep(1)
+        await running_tasks.run(user_id, run_batch(client, user_id, start.chat, start_id, end_id, start.is_private))
             
     except Exception as e:
         await message.reply(f"❌ Batch error: {str(e)}")
@@ -319,16 +271,15 @@ async def handle_login_steps(client, message: Message):
 @app.on_message(filters.command("cancel") & filters.private)
 async def cancel_downloads(client, message):
     user_id = message.from_user.id
-    from bot.config import active_downloads, cancel_flags
+    from bot.task_registry import running_tasks
+    from bot.database import cancel_user_jobs
     
-    if user_id in active_downloads:
-        cancel_flags.add(user_id)
-        active_downloads.discard(user_id) # Force discard immediately as well
-        await message.reply("🛑 Download cancellation request sent. Your process has been removed from active list.")
+    # Stops transfers mid-file; their slots and partial files are released right away
+    cancelled = running_tasks.cancel_user(user_id)
+    cancelled += await cancel_user_jobs(user_id)
+    if cancelled:
+        await message.reply("🛑 Your downloads have been cancelled.")
     else:
-        # Just in case the flag was set but not in active_downloads
-        if user_id in cancel_flags:
-            cancel_flags.discard(user_id)
         await message.reply("No active downloads to cancel.")
 
 @app.on_message(filters.command("cancel_login") & filters.private)
@@ -362,6 +313,7 @@ async def logout(client, message):
         del login_states[user_id]
 
     if user and user.get('phone_session_string'):
+        await user_client_pool.discard(user_id)
         await logout_user(user_id)
         await message.reply("✅ Logged out successfully! Your session has been cleared.")
     else:
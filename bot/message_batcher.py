@@ -0,0 +1,78 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# How long a lookup waits for others on the same chat before the request goes out
+BATCH_WINDOW = 0.005
+# Most message ids messages.GetMessages/channels.GetMessages accept at once
+MAX_IDS_PER_CALL = 200
+
+class _Batch:
+    __slots__ = ("client", "chat_id", "waiters", "timer")
+
+    def __init__(self, client, chat_id):
+        self.client = client
+        self.chat_id = chat_id
+        # message id -> futures of the callers waiting for it
+        self.waiters = {}
+        self.timer = None
+
+class MessageBatcher:
+    """
+    Coalesces get_messages lookups. Lookups for the same chat through the same client that
+    arrive within BATCH_WINDOW of each other are sent as one multi-id get_messages call (up to
+    MAX_IDS_PER_CALL ids) and the results handed back to every caller.
+    """
+    def __init__(self, window=BATCH_WINDOW, max_ids=MAX_IDS_PER_CALL):
+        self.window = window
+        self.max_ids = max_ids
+        self.batches = {}
+
+    @staticmethod
+    def _key(client, chat_id):
+        return id(client), str(chat_id).lower()
+
+    def get(self, client, chat_id, message_id):
+        """Awaitable for the message, like `client.get_messages(chat_id, message_id)`"""
+        key = self._key(client, chat_id)
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = self.batches[key] = _Batch(client, chat_id)
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._flush, key, batch)
+        future = asyncio.get_running_loop().create_future()
+        batch.waiters.setdefault(int(message_id), []).append(future)
+        if len(batch.waiters) >= self.max_ids:
+            self._flush(key, batch)
+        return future
+
+    async def get_many(self, client, chat_id, message_ids):
+        """Fetches a range of messages in as few calls as possible. Returns {message id: message}."""
+        message_ids = list(message_ids)
+        results = await asyncio.gather(*(self.get(client, chat_id, message_id) for message_id in message_ids))
+        return dict(zip(message_ids, results))
+
+    def _flush(self, key, batch):
+        if self.batches.get(key) is batch:
+            del self.batches[key]
+        batch.timer.cancel()
+        asyncio.ensure_future(self._fetch(batch))
+
+    async def _fetch(self, batch):
+        ids = list(batch.waiters)
+        try:
+            messages = await batch.client.get_messages(batch.chat_id, ids)
+            if len(ids) > 1:
+                logger.debug(f"Fetched {len(ids)} messages of {batch.chat_id} in one call")
+        except Exception as e:
+            for futures in batch.waiters.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for message_id, message in zip(ids, messages):
+            for future in batch.waiters[message_id]:
+                if not future.done():
+                    future.set_result(message)
+
+message_batcher = MessageBatcher()
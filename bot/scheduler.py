@@ -0,0 +1,182 @@
+import time
+import asyncio
+import logging
+import itertools
+from bot.config import (
+    MAX_CONCURRENT_DOWNLOADS, PREMIUM_WEIGHT, PREMIUM_MAX_JOBS, PREMIUM_MAX_PENDING,
+    FREE_MAX_PENDING, QUEUE_DEADLINE
+)
+
+logger = logging.getLogger(__name__)
+
+# Rough transfer cost model used to order jobs (seconds): fixed overhead + size / speed
+JOB_OVERHEAD = 2
+ESTIMATED_SPEED = 5 * 1024 * 1024
+# How often waiting jobs check whether their queue position changed
+POSITION_UPDATE_INTERVAL = 5
+
+class Job:
+    __slots__ = (
+        "id", "user_id", "premium", "size", "submitted", "deadline", "state",
+        "granted", "position", "on_position"
+    )
+
+    def __init__(self, job_id, user_id, premium, size=0, on_position=None):
+        self.id = job_id
+        self.user_id = user_id
+        self.premium = premium
+        self.size = size
+        self.submitted = time.time()
+        self.deadline = None
+        # pending (submitted, not queued yet) -> queued -> running -> done
+        self.state = "pending"
+        self.granted = asyncio.Event()
+        self.position = None
+        self.on_position = on_position
+
+    @property
+    def weight(self):
+        return PREMIUM_WEIGHT if self.premium else 1
+
+    @property
+    def cost(self):
+        return JOB_OVERHEAD + self.size / ESTIMATED_SPEED
+
+class FairScheduler:
+    """
+    Hands out the global transfer slots to queued jobs.
+
+    Users get slots in proportion to their weight (premium > free) using start-time fair
+    queueing: every user has a virtual clock that advances by cost/weight for each job it
+    is granted, and the waiting job with the smallest virtual finish time runs next. Since
+    the cost is estimated from the file size, small jobs naturally overtake big ones. To keep
+    big jobs from starving, a job that has waited past its deadline (QUEUE_DEADLINE + its own
+    cost) goes before everything that is still within its deadline.
+    """
+    def __init__(self, slots=MAX_CONCURRENT_DOWNLOADS):
+        self.slots = slots
+        self.jobs = {}
+        self.user_vtime = {}
+        self.vclock = 0.0
+        self.ids = itertools.count(1)
+
+    def user_jobs(self, user_id):
+        return [job for job in self.jobs.values() if job.user_id == user_id]
+
+    @property
+    def running(self):
+        return [job for job in self.jobs.values() if job.state == "running"]
+
+    @property
+    def queued(self):
+        return [job for job in self.jobs.values() if job.state == "queued"]
+
+    def submit(self, user_id, premium=False, on_position=None):
+        """Registers a job for the user, or returns None if they already have as many as allowed"""
+        limit = PREMIUM_MAX_PENDING if premium else FREE_MAX_PENDING
+        if len(self.user_jobs(user_id)) >= limit:
+            return None
+        job = Job(next(self.ids), user_id, premium, on_position=on_position)
+        self.jobs[job.id] = job
+        return job
+
+    def _finish_tag(self, job):
+        start = max(self.user_vtime.get(job.user_id, 0.0), self.vclock)
+        return start + job.cost / job.weight
+
+    def _order_key(self, job, now):
+        overdue = now >= job.deadline
+        # Overdue jobs by deadline first, everyone else by virtual finish time
+        return (0, job.deadline) if overdue else (1, self._finish_tag(job), job.deadline)
+
+    def _eligible(self):
+        running = {}
+        for job in self.jobs.values():
+            if job.state == "running":
+                running[job.user_id] = running.get(job.user_id, 0) + 1
+        return [
+            job for job in self.jobs.values()
+            if job.state == "queued" and running.get(job.user_id, 0) < (PREMIUM_MAX_JOBS if job.premium else 1)
+        ]
+
+    def _dispatch(self):
+        while len(self.running) < self.slots:
+            candidates = self._eligible()
+            if not candidates:
+                return
+            now = time.time()
+            job = min(candidates, key=lambda j: self._order_key(j, now))
+            start = max(self.user_vtime.get(job.user_id, 0.0), self.vclock)
+            self.user_vtime[job.user_id] = start + job.cost / job.weight
+            self.vclock = start
+            job.state = "running"
+            job.position = 0
+            job.granted.set()
+
+    def _positions(self):
+        now = time.time()
+        ordered = sorted(self.queued, key=lambda j: self._order_key(j, now))
+        return {job.id: position for position, job in enumerate(ordered, 1)}
+
+    async def acquire(self, job, size=None, urgent=False):
+        """Queues the job and waits for a slot"""
+        if size is not None:
+            job.size = size
+        # Urgent jobs start out overdue, so they go first
+        job.deadline = time.time() + (0 if urgent else QUEUE_DEADLINE + job.cost)
+        job.granted.clear()
+        job.state = "queued"
+        self._dispatch()
+
+        while job.state == "queued":
+            try:
+                await asyncio.wait_for(job.granted.wait(), timeout=POSITION_UPDATE_INTERVAL if job.position is not None else 0.5)
+            except asyncio.TimeoutError:
+                pass
+            if job.state != "queued":
+                break
+            # Deadlines may have passed meanwhile, which changes the order
+            self._dispatch()
+            position = self._positions().get(job.id)
+            if position and position != job.position:
+                job.position = position
+                if job.on_position:
+                    try:
+                        await job.on_position(position, len(self.queued))
+                    except Exception as e:
+                        logger.debug(f"Queue position update failed: {e}")
+
+    def suspend(self, job):
+        """Gives the job's slot away while it waits on something that doesn't need one"""
+        if job.state == "running":
+            job.state = "pending"
+            self._dispatch()
+
+    async def resume(self, job):
+        """Takes a slot again after suspend(); goes ahead of jobs that haven't started"""
+        if job.state != "pending":
+            return
+        # Already paid for its share when it was first granted
+        job.size = 0
+        await self.acquire(job, urgent=True)
+
+    def release(self, job):
+        """Finishes the job (running or not) and hands its slot to the next one. Safe to call twice."""
+        if self.jobs.pop(job.id, None) is None:
+            return
+        job.state = "done"
+        job.granted.set()
+        if not any(j.user_id == job.user_id for j in self.jobs.values()):
+            # Idle users don't bank credit; they restart at the current virtual time
+            self.user_vtime.pop(job.user_id, None)
+        self._dispatch()
+
+    def stats(self):
+        return {
+            "running": len(self.running),
+            "queued": len(self.queued),
+            "slots": self.slots,
+            "users": len({job.user_id for job in self.jobs.values()})
+        }
+
+scheduler = FairScheduler()
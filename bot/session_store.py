@@ -0,0 +1,89 @@
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+from pathlib import Path
+from pyrogram.storage import SQLiteStorage
+from bot.config import BOT_TOKEN, BOT_SESSION_MODE
+from bot.database import get_setting, update_setting
+
+logger = logging.getLogger(__name__)
+
+# Settings row holding the bot's exported session string. The database is what the cloud
+# backup uploads, so a redeploy on a fresh disk can rebuild the session file from it.
+SETTINGS_KEY = "bot_session"
+
+def _bot_id():
+    return (BOT_TOKEN or "").split(":")[0]
+
+def _session_path(client):
+    return Path(client.workdir) / (client.name + SQLiteStorage.FILE_EXTENSION)
+
+async def restore_bot_session(client):
+    """
+    Recreates the bot's session file from the copy saved in the database when the file is
+    missing (fresh container after a restore from cloud backup). Must run before the client starts.
+    """
+    if BOT_SESSION_MODE != "file":
+        return False
+    path = _session_path(client)
+    if path.exists():
+        return False
+
+    setting = await get_setting(SETTINGS_KEY)
+    if not setting or not setting.get("json_value"):
+        return False
+    try:
+        saved = json.loads(setting["json_value"])
+    except ValueError:
+        return False
+    if saved.get("bot_id") != _bot_id():
+        logger.info("Saved bot session belongs to another bot token, authorizing from scratch")
+        return False
+
+    try:
+        # Let pyrogram decode the session string into an in-memory session, then copy it to disk
+        storage = SQLiteStorage(client.name, Path(client.workdir), session_string=saved["session"], in_memory=True)
+        await storage.open()
+        target = sqlite3.connect(str(path))
+        try:
+            storage.conn.backup(target)
+            target.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            target.close()
+            await storage.close()
+        logger.info(f"Restored bot session file {path} from database")
+        return True
+    except Exception as e:
+        logger.error(f"Could not restore bot session: {e}")
+        try:
+            path.unlink()
+        except OSError:
+            pass
+        return False
+
+async def persist_bot_session(client):
+    """Saves the bot's session string to the database once the client has authorized"""
+    if BOT_SESSION_MODE != "file":
+        return
+    while not client.is_initialized:
+        await asyncio.sleep(1)
+
+    try:
+        session = await client.export_session_string()
+        setting = await get_setting(SETTINGS_KEY)
+        if setting and setting.get("json_value"):
+            if json.loads(setting["json_value"]).get("session") == session:
+                return
+        await update_setting(SETTINGS_KEY, None, json.dumps({
+            "bot_id": _bot_id(),
+            "session": session,
+            "saved_at": int(time.time())
+        }))
+        logger.info("Saved bot session to database")
+
+        from bot.cloud_backup import trigger_backup_on_critical_change
+        trigger_backup_on_critical_change("bot_session")
+    except Exception as e:
+        logger.error(f"Could not save bot session: {e}")
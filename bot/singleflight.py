@@ -0,0 +1,58 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Flight:
+    """One in-progress transfer that several requests are waiting on"""
+    def __init__(self, key, progress_callback=None):
+        self.key = key
+        self.progress_callback = progress_callback
+        self.future = asyncio.get_running_loop().create_future()
+        self.watchers = []
+
+    async def progress(self, current, total, message, *args):
+        """Progress callback for the leader: reports to its own status message and every waiter's"""
+        if not self.progress_callback:
+            return
+        for target in [message, *self.watchers]:
+            try:
+                await self.progress_callback(current, total, target, *args)
+            except Exception as e:
+                logger.debug(f"Flight progress update failed: {e}")
+
+    async def wait(self, message=None):
+        """Waits for the leader's result; `message` gets the leader's progress updates meanwhile"""
+        if message is not None:
+            self.watchers.append(message)
+        try:
+            return await asyncio.shield(self.future)
+        finally:
+            if message is not None and message in self.watchers:
+                self.watchers.remove(message)
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent transfers. The first caller for a key becomes the
+    leader and does the work, callers arriving while it runs wait for its result
+    instead of starting their own transfer.
+    """
+    def __init__(self, progress_callback=None):
+        self.flights = {}
+        self.progress_callback = progress_callback
+
+    def join(self, key):
+        """Returns (flight, is_leader) for `key`"""
+        flight = self.flights.get(key)
+        if flight:
+            logger.info(f"SingleFlight: joining transfer in progress for {key} ({len(flight.watchers) + 1} waiting)")
+            return flight, False
+        flight = self.flights[key] = Flight(key, self.progress_callback)
+        return flight, True
+
+    def finish(self, flight, result=None):
+        """Publishes the leader's result (None on failure) and retires the flight. Safe to call twice."""
+        if not flight.future.done():
+            flight.future.set_result(result)
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
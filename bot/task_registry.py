@@ -0,0 +1,82 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class TaskRegistry:
+    """
+    Tracks the task running each user's download or batch so /cancel and /killall can stop it
+    mid-transfer. Cancelling the task propagates into whatever it awaits: the part workers of
+    parallel_download/parallel_upload/relay_media are cancelled by gather_or_cancel, the
+    scheduler slot is released in run_download's cleanup, and the partial file is removed.
+    """
+    def __init__(self):
+        self.tasks = {}
+        # Tasks cancelled on request, as opposed to cancelled by a shutdown (whose jobs resume later)
+        self.cancelled = set()
+        self.shutting_down = False
+
+    async def run(self, user_id, coro):
+        """Runs `coro` as a cancellable task of the user and waits for it. Returns None if it was cancelled."""
+        task = asyncio.ensure_future(coro)
+        self.tasks.setdefault(user_id, set()).add(task)
+        try:
+            # wait() doesn't raise when the task is cancelled, which keeps the caller
+            # (e.g. pyrogram's handler worker) alive
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            # A task cancelled on request (e.g. a /batch) takes the task it runs along with it
+            if self.cancel_requested():
+                self.cancelled.add(task)
+            task.cancel()
+            raise
+        finally:
+            tasks = self.tasks.get(user_id)
+            if tasks:
+                tasks.discard(task)
+                if not tasks:
+                    del self.tasks[user_id]
+            # Keep the mark until the task has handled its cancellation
+            if task.done():
+                self.cancelled.discard(task)
+            else:
+                task.add_done_callback(self.cancelled.discard)
+        if task.cancelled():
+            return None
+        return task.result()
+
+    def user_tasks(self, user_id):
+        return [task for task in self.tasks.get(user_id, ()) if not task.done()]
+
+    def cancel_user(self, user_id):
+        """Cancels all of the user's running tasks. Returns how many were cancelled."""
+        tasks = self.user_tasks(user_id)
+        for task in tasks:
+            self.cancelled.add(task)
+            task.cancel()
+        if tasks:
+            logger.info(f"Cancelled {len(tasks)} tasks of user {user_id}")
+        return len(tasks)
+
+    def cancel_all(self):
+        return sum(self.cancel_user(user_id) for user_id in list(self.tasks))
+
+    def cancel_requested(self, task=None):
+        """Whether `task` (default: the current one) was cancelled through cancel_user()/cancel_all()"""
+        return (task or asyncio.current_task()) in self.cancelled
+
+    def interrupted_by_shutdown(self, task=None):
+        """Whether `task` (default: the current one) was cancelled by shutdown(), so its job should resume after the restart"""
+        return self.shutting_down and not self.cancel_requested(task)
+
+    async def shutdown(self, timeout=10):
+        """Cancels every running task without marking it as requested, and waits for their cleanup"""
+        self.shutting_down = True
+        tasks = [task for tasks in self.tasks.values() for task in tasks if not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            logger.info(f"Shutdown: cancelled {len(tasks)} running tasks, their jobs resume after the restart")
+            await asyncio.wait(tasks, timeout=timeout)
+
+running_tasks = TaskRegistry()
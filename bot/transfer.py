@@ -2,91 +2,762 @@ import math
 import os
 import time
 import asyncio
+import json
+import inspect
+import hashlib
+import mimetypes
 import logging
 from pyrogram import Client, utils
 from pyrogram.raw import types, functions
-from bot.config import get_smart_download_workers, get_smart_upload_workers, get_smart_chunk_size
+from pyrogram.errors import FilePartMissing, InternalServerError, FloodWait, BadRequest
+from pyrogram.file_id import FileId, FileType
+from bot.config import RELAY_BUFFER_PARTS
+from bot.autotune import tuner, TransferStats
 
-async def download_media_fast(client: Client, message, file_name, progress_callback=None, progress_args=()):
-    """Fast media downloader using smart download-specific worker logic"""
-    # Use helper to get file size from various media types, including Story objects
-    def get_file_size(m):
-        if hasattr(m, "video") and m.video: return getattr(m.video, "file_size", 0)
-        if hasattr(m, "document") and m.document: return getattr(m.document, "file_size", 0)
-        if hasattr(m, "audio") and m.audio: return getattr(m.audio, "file_size", 0)
-        if hasattr(m, "photo") and m.photo: return getattr(m.photo, "file_size", 0)
+# Resumable partial downloads live here, keyed by file_unique_id
+PARTIAL_DIR = "downloads/.partial"
+# Checkpoint the part manifest at most this often (seconds)
+MANIFEST_FLUSH_INTERVAL = 2
+# Attempts per download before giving up (each attempt resumes the previous one)
+DOWNLOAD_RETRIES = 3
+# Partial downloads untouched for this long (seconds) are deleted
+PARTIAL_MAX_AGE = 24 * 3600
+
+# Locks for partial files currently being written, keyed by file_unique_id
+partial_locks = {}
+
+# Media attributes checked (in order) when looking for the downloadable part of a Message or Story
+MEDIA_ATTRS = ("video", "document", "audio", "photo", "voice", "animation", "video_note")
+
+class CdnRedirect(Exception):
+    """Raised when Telegram serves the file from a CDN DC, which the parallel engine does not handle."""
+
+def get_media(message):
+    for attr in MEDIA_ATTRS:
+        media = getattr(message, attr, None)
+        if media:
+            return media
+    return None
+
+def get_file_location(file_id: FileId):
+    """Builds the raw InputFileLocation for a decoded file id (same rules as Client.get_file)"""
+    if file_id.file_type == FileType.PHOTO:
+        return types.InputPhotoFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size
+        )
+    return types.InputDocumentFileLocation(
+        id=file_id.media_id,
+        access_hash=file_id.access_hash,
+        file_reference=file_id.file_reference,
+        thumb_size=file_id.thumbnail_size
+    )
+
+async def report_progress(progress_callback, current, total, progress_args=()):
+    if not progress_callback:
+        return
+    try:
+        if inspect.iscoroutinefunction(progress_callback):
+            await progress_callback(current, total, *progress_args)
+        else:
+            progress_callback(current, total, *progress_args)
+    except Exception as e:
+        logging.debug(f"Progress callback failed: {e}")
+
+async def open_media_sessions(client: Client, dc_id, count):
+    """
+    Returns `count` media sessions for `dc_id`: the client's shared media session plus
+    `count - 1` temporary ones (each its own TCP connection). Temporary sessions must be
+    stopped with close_media_sessions() once the transfer is over.
+    """
+    shared = await client.get_session(dc_id, is_media=True)
+    results = await asyncio.gather(
+        *[client.get_session(dc_id, is_media=True, temporary=True) for _ in range(count - 1)],
+        return_exceptions=True
+    )
+    sessions = [shared]
+    for result in results:
+        if isinstance(result, BaseException):
+            logging.warning(f"Extra media session to DC{dc_id} failed: {result}")
+        else:
+            sessions.append(result)
+    return sessions
+
+async def close_media_sessions(sessions):
+    # The first session is the client's shared one and stays open
+    for session in sessions[1:]:
+        try:
+            await session.stop()
+        except Exception:
+            pass
+
+async def gather_or_cancel(tasks):
+    """Waits for all worker tasks; if one fails (or we are cancelled) the others are cancelled too"""
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def invoke_part(session, rpc, stats: TransferStats = None):
+    """Invokes a part request, sleeping through FloodWaits and counting them (and errors) for the tuner"""
+    while True:
+        try:
+            return await session.invoke(rpc, sleep_threshold=0)
+        except FloodWait as e:
+            if stats:
+                stats.flood_waits += 1
+            logging.warning(f"FloodWait on {type(rpc).__name__}: sleeping {e.value}s")
+            await asyncio.sleep(e.value)
+        except Exception:
+            if stats:
+                stats.errors += 1
+            raise
+
+async def fetch_part(session, location, offset, limit, stats: TransferStats = None):
+    r = await invoke_part(
+        session,
+        functions.upload.GetFile(location=location, offset=offset, limit=limit),
+        stats
+    )
+    if isinstance(r, types.upload.FileCdnRedirect):
+        raise CdnRedirect()
+    return r.bytes
+
+class PartManifest:
+    """
+    Sidecar checkpoint for a partial download: `<partial>.json` records the file it belongs
+    to and which chunk_size-aligned parts are already written to `<partial>`.
+    """
+    def __init__(self, partial_path, file_unique_id, file_size, chunk_size):
+        self.path = partial_path + ".json"
+        self.file_unique_id = file_unique_id
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.parts = set()
+        self.last_flush = 0
+
+    @staticmethod
+    def saved_chunk_size(partial_path):
+        """Chunk size a previous attempt used, so a resume keeps the same part boundaries"""
+        try:
+            with open(partial_path + ".json") as f:
+                return json.load(f).get("chunk_size")
+        except (OSError, ValueError):
+            return None
+
+    def load(self, partial_path):
+        """Loads completed parts from a previous attempt, if it was for the same file"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (
+            data.get("file_unique_id") == self.file_unique_id
+            and data.get("file_size") == self.file_size
+            and data.get("chunk_size") == self.chunk_size
+            and os.path.exists(partial_path)
+            and os.path.getsize(partial_path) == self.file_size
+        ):
+            self.parts = set(data.get("parts", []))
+
+    def flush(self):
+        data = {
+            "file_unique_id": self.file_unique_id,
+            "file_size": self.file_size,
+            "chunk_size": self.chunk_size,
+            "parts": sorted(self.parts)
+        }
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.path)
+        self.last_flush = time.time()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def get_partial_path(client: Client, file_unique_id):
+    return os.path.abspath(os.path.join(client.workdir, PARTIAL_DIR, f"{file_unique_id}.partial"))
+
+async def parallel_download(client: Client, media, file_name, workers, chunk_size, progress_callback=None, progress_args=(), stats: TransferStats = None):
+    """
+    Downloads `media` with `workers` concurrent GetFile streams. The file is split into
+    chunk_size-aligned parts, and every part is written at its own offset into a
+    preallocated partial file which is moved to `file_name` once all parts are in.
+
+    The partial file is keyed by file_unique_id and checkpointed in a PartManifest, so a
+    download that times out, loses its connection or is cut by a restart picks up the
+    missing parts on the next attempt (from any user) instead of starting over.
+    """
+    file_size = media.file_size
+    file_id = FileId.decode(media.file_id)
+    location = get_file_location(file_id)
+    part_count = math.ceil(file_size / chunk_size)
+    loop = asyncio.get_running_loop()
+
+    file_path = os.path.abspath(os.path.join(client.workdir, file_name))
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    partial_path = get_partial_path(client, media.file_unique_id)
+    os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+
+    # Two jobs for the same file must not write the same partial at once
+    lock = partial_locks.setdefault(media.file_unique_id, asyncio.Lock())
+    async with lock:
+        manifest = PartManifest(partial_path, media.file_unique_id, file_size, chunk_size)
+        manifest.load(partial_path)
+        if manifest.parts:
+            logging.info(f"Resuming {file_name}: {len(manifest.parts)}/{part_count} parts already on disk")
+        else:
+            manifest.flush()
+
+        fd = os.open(partial_path, os.O_RDWR | os.O_CREAT, 0o644)
+        sessions = []
+        try:
+            if not manifest.parts:
+                os.ftruncate(fd, file_size)
+            async with client.get_file_semaphore:
+                pending = [p for p in range(part_count - 1, -1, -1) if p not in manifest.parts]
+                done = sum(min(chunk_size, file_size - p * chunk_size) for p in manifest.parts)
+                if pending:
+                    sessions = await open_media_sessions(client, file_id.dc_id, min(workers, len(pending)))
+
+                async def worker(session):
+                    nonlocal done
+                    while pending:
+                        part = pending.pop()
+                        offset = part * chunk_size
+                        data = await fetch_part(session, location, offset, chunk_size, stats)
+                        await loop.run_in_executor(None, os.pwrite, fd, data, offset)
+                        if stats:
+                            stats.bytes += len(data)
+                        manifest.parts.add(part)
+                        if time.time() - manifest.last_flush >= MANIFEST_FLUSH_INTERVAL:
+                            manifest.flush()
+                        done += len(data)
+                        await report_progress(progress_callback, min(done, file_size), file_size, progress_args)
+
+                await gather_or_cancel([asyncio.ensure_future(worker(s)) for s in sessions])
+        except BaseException:
+            # Keep the partial file, record what made it to disk so the next attempt resumes
+            os.close(fd)
+            try:
+                manifest.flush()
+            except OSError as e:
+                logging.warning(f"Could not checkpoint {partial_path}: {e}")
+            raise
+        finally:
+            await close_media_sessions(sessions)
+
+        os.close(fd)
+        os.replace(partial_path, file_path)
+        manifest.remove()
+    return file_path
+
+def discard_partial_download(client: Client, file_unique_id):
+    """Deletes a cancelled download's partial file and manifest, unless another transfer is writing it"""
+    lock = partial_locks.get(file_unique_id)
+    if lock and lock.locked():
+        return False
+    partial_path = get_partial_path(client, file_unique_id)
+    for path in (partial_path, partial_path + ".json"):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return True
+
+def cleanup_partial_downloads(workdir, max_age):
+    """Deletes partial downloads (and their manifests) nobody resumed for `max_age` seconds"""
+    directory = os.path.join(workdir, PARTIAL_DIR)
+    if not os.path.isdir(directory):
         return 0
+    removed = 0
+    now = time.time()
+    for name in os.listdir(directory):
+        lock = partial_locks.get(name.split(".partial")[0])
+        if lock and lock.locked():
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            pass
+    for key, lock in list(partial_locks.items()):
+        if not lock.locked():
+            partial_locks.pop(key, None)
+    return removed
+
+async def partial_cleanup_loop(client: Client):
+    """Periodically drops stale partial downloads so abandoned files don't fill the disk"""
+    while True:
+        await asyncio.sleep(3600)
+        try:
+            removed = cleanup_partial_downloads(client.workdir, PARTIAL_MAX_AGE)
+            if removed:
+                logging.info(f"Partial Cleanup: removed {removed} stale partial download files")
+        except Exception as e:
+            logging.error(f"Partial cleanup error: {e}")
 
-    file_size = get_file_size(message)
-    workers = get_smart_download_workers(file_size)
-    chunk_size = get_smart_chunk_size(file_size)
+async def download_media_fast(client: Client, message, file_name, progress_callback=None, progress_args=()):
+    """Fast media downloader using smart download-specific worker logic"""
+    media = get_media(message)
+    file_size = getattr(media, "file_size", 0) or 0
+    dc_id = FileId.decode(media.file_id).dc_id if media else None
+    workers, chunk_size = tuner.settings(dc_id, "download", file_size)
+    
+    if media and file_size and workers > 1:
+        partial_path = get_partial_path(client, media.file_unique_id)
+        chunk_size = PartManifest.saved_chunk_size(partial_path) or chunk_size
     
     # Logging to verify smart logic is working
     logging.info(f"Smart Download: File={file_name}, Size={file_size}, Workers={workers}, Chunk={chunk_size}")
     
-    # Standard Pyrogram/Kurigram .download() does not natively use multi-workers 
-    # to speed up a single file download. We need to use raw transmission for that.
+    if media and file_size and workers > 1:
+        start = time.time()
+        for attempt in range(1, DOWNLOAD_RETRIES + 1):
+            stats = TransferStats()
+            try:
+                path = await parallel_download(
+                    client, media, file_name, workers, chunk_size,
+                    progress_callback=progress_callback,
+                    progress_args=progress_args,
+                    stats=stats
+                )
+                logging.info(f"Parallel Download: {file_name} done in {time.time() - start:.1f}s")
+                return path
+            except CdnRedirect:
+                logging.info(f"Parallel Download: {file_name} is served from CDN, using sequential download")
+                break
+            except (OSError, TimeoutError, InternalServerError) as e:
+                # Completed parts are checkpointed, so the retry only fetches what is missing
+                if attempt == DOWNLOAD_RETRIES:
+                    raise
+                logging.warning(f"Parallel Download: {file_name} failed ({e}), resuming (attempt {attempt + 1}/{DOWNLOAD_RETRIES})")
+                await asyncio.sleep(2)
+            finally:
+                tuner.record(dc_id, "download", workers, chunk_size, stats)
+    
+    # Small files (and CDN-hosted ones) go through the standard single-stream download
     return await message.download(
         file_name, 
         progress=progress_callback, 
         progress_args=progress_args
     )
 
-async def upload_media_fast(client: Client, chat_id, file_path, caption="", progress_callback=None, **kwargs):
-    """Fast media uploader using smart upload-specific worker logic"""
-    file_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
-    workers = get_smart_upload_workers(file_size)
-    chunk_size = get_smart_chunk_size(file_size)
-    
-    # Logging to verify smart logic is working
-    logging.info(f"Smart Upload: File={file_path}, Size={file_size}, Workers={workers}, Chunk={chunk_size}")
+async def save_part(session, file_id, part, data, total_parts, is_big, stats: TransferStats = None):
+    if is_big:
+        rpc = functions.upload.SaveBigFilePart(
+            file_id=file_id, file_part=part, file_total_parts=total_parts, bytes=data
+        )
+    else:
+        rpc = functions.upload.SaveFilePart(file_id=file_id, file_part=part, bytes=data)
+    await invoke_part(session, rpc, stats)
+
+async def parallel_upload(client: Client, file_path, workers, chunk_size, progress_callback=None, progress_args=(), stats: TransferStats = None):
+    """
+    Uploads `file_path` with `workers` concurrent SaveFilePart streams, each on its own
+    media-DC connection. Returns the InputFile/InputFileBig to attach to a SendMedia call.
+    """
+    file_size = os.path.getsize(file_path)
+    if file_size == 0:
+        raise ValueError("File size equals to 0 B")
+
+    total_parts = math.ceil(file_size / chunk_size)
+    is_big = file_size > 10 * 1024 * 1024
+    file_id = client.rnd_id()
+    md5_sum = None if is_big else hashlib.md5()
+    loop = asyncio.get_running_loop()
+    # Bounded so that only a few parts per worker are ever held in memory
+    queue = asyncio.Queue(workers * 2)
+    done = 0
+
+    async def worker(session):
+        nonlocal done
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            part, data = item
+            await save_part(session, file_id, part, data, total_parts, is_big, stats)
+            done += len(data)
+            if stats:
+                stats.bytes += len(data)
+            await report_progress(progress_callback, min(done, file_size), file_size, progress_args)
+
+    sessions = []
+    tasks = []
+    try:
+        async with client.save_file_semaphore:
+            dc_id = await client.storage.dc_id()
+            sessions = await open_media_sessions(client, dc_id, min(workers, total_parts))
+            tasks = [asyncio.ensure_future(worker(s)) for s in sessions]
+
+            with open(file_path, "rb") as fp:
+                for part in range(total_parts):
+                    data = await loop.run_in_executor(None, fp.read, chunk_size)
+                    if md5_sum:
+                        md5_sum.update(data)
+                    # Surface a failed worker instead of blocking forever on a full queue
+                    put = asyncio.ensure_future(queue.put((part, data)))
+                    finished, _ = await asyncio.wait([put, *tasks], return_when=asyncio.FIRST_COMPLETED)
+                    if put not in finished:
+                        put.cancel()
+                        for task in finished:
+                            task.result()
+                        raise RuntimeError("Upload worker stopped unexpectedly")
+
+            for _ in tasks:
+                await queue.put(None)
+            await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        await close_media_sessions(sessions)
+
+    name = os.path.basename(file_path)
+    if is_big:
+        return types.InputFileBig(id=file_id, parts=total_parts, name=name)
+    return types.InputFile(id=file_id, parts=total_parts, name=name, md5_checksum=md5_sum.hexdigest())
+
+async def reupload_part(client: Client, input_file, part, data):
+    """Re-sends a single part Telegram reported as missing (FILE_PART_X_MISSING)"""
+    session = await client.get_session(await client.storage.dc_id(), is_media=True)
+    is_big = isinstance(input_file, types.InputFileBig)
+    await save_part(session, input_file.id, part, data, input_file.parts, is_big)
+
+async def send_uploaded_media(client: Client, chat_id, input_file, media, read_part, caption=""):
+    """
+    Sends an already uploaded file with messages.SendMedia and returns the parsed Message.
+    `read_part(part)` must return the bytes of a part, in case Telegram asks for it again.
+    """
+    while True:
+        try:
+            r = await client.invoke(
+                functions.messages.SendMedia(
+                    peer=await client.resolve_peer(chat_id),
+                    media=media,
+                    random_id=client.rnd_id(),
+                    **await utils.parse_text_entities(client, caption or "", client.parse_mode, None)
+                )
+            )
+        except FilePartMissing as e:
+            part = int(e.file_part)
+            await reupload_part(client, input_file, part, await read_part(part))
+        else:
+            messages = await utils.parse_messages(client, r)
+            return messages[0] if messages else None
+
+async def uploaded_media_candidates(client: Client, input_file, file_name, mime_type=None, **kwargs):
+    """
+    InputMedia variants for an uploaded file, in the order to try them: video, photo or voice
+    when the name/kwargs say so, with a plain document as the fallback
+    """
+    lower_name = file_name.lower()
+    thumb = kwargs.get("thumb")
     
     # Check if this is a video upload by checking for 'duration' or other video-specific kwargs
-    if "duration" in kwargs or file_path.lower().endswith((".mp4", ".mkv", ".mov", ".avi")):
-        return await client.send_video(
-            chat_id, 
-            file_path, 
-            caption=caption, 
-            progress=progress_callback,
-            **kwargs
-        )
+    if "duration" in kwargs or lower_name.endswith((".mp4", ".mkv", ".mov", ".avi")):
+        return [types.InputMediaUploadedDocument(
+            mime_type=mime_type or client.guess_mime_type(file_name) or "video/mp4",
+            file=input_file,
+            thumb=await client.save_file(thumb) if thumb else None,
+            attributes=[
+                types.DocumentAttributeVideo(
+                    supports_streaming=kwargs.get("supports_streaming") or None,
+                    duration=kwargs.get("duration") or 0,
+                    w=kwargs.get("width") or 0,
+                    h=kwargs.get("height") or 0
+                ),
+                types.DocumentAttributeFilename(file_name=file_name)
+            ]
+        )]
     
+    candidates = []
     # If it's a photo, send it as a photo instead of a document to avoid PHOTO_EXT_INVALID
-    if file_path.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
+    if lower_name.endswith((".jpg", ".jpeg", ".png", ".webp")):
         # Ensure we have the right extension for Telegram
-        if not file_path.lower().endswith((".jpg", ".jpeg")):
+        if not lower_name.endswith((".jpg", ".jpeg")):
              # Telegram is picky about photo extensions in SendMedia
-             logging.info(f"Photo extension check: {file_path}")
-        
-        try:
-            return await client.send_photo(
-                chat_id,
-                file_path,
-                caption=caption,
-                progress=progress_callback,
-                **kwargs
-            )
-        except Exception as e:
-            logging.warning(f"Failed to send as photo, falling back to document: {e}")
-            # Fallback to document if send_photo fails
-        
+             logging.info(f"Photo extension check: {file_name}")
+        candidates.append(types.InputMediaUploadedPhoto(file=input_file))
+    
     # If it's a voice message (ogg), send it as a voice
-    if file_path.lower().endswith(".ogg"):
+    elif lower_name.endswith(".ogg"):
+        candidates.append(types.InputMediaUploadedDocument(
+            mime_type="audio/ogg",
+            file=input_file,
+            attributes=[types.DocumentAttributeAudio(voice=True, duration=kwargs.get("duration") or 0)]
+        ))
+    
+    candidates.append(types.InputMediaUploadedDocument(
+        mime_type=mime_type or client.guess_mime_type(file_name) or "application/octet-stream",
+        file=input_file,
+        thumb=await client.save_file(thumb) if thumb else None,
+        attributes=[types.DocumentAttributeFilename(file_name=file_name)]
+    ))
+    return candidates
+
+async def send_input_file(client: Client, chat_id, input_file, file_name, read_part, caption="", mime_type=None, **kwargs):
+    """Attaches an uploaded file to the right kind of media (video, photo, voice or document) and sends it"""
+    candidates = await uploaded_media_candidates(client, input_file, file_name, mime_type, **kwargs)
+    for media in candidates[:-1]:
         try:
-            return await client.send_voice(
-                chat_id,
-                file_path,
-                caption=caption,
-                progress=progress_callback,
-                **kwargs
-            )
+            return await send_uploaded_media(client, chat_id, input_file, media, read_part, caption=caption)
         except Exception as e:
-            logging.warning(f"Failed to send as voice, falling back to document: {e}")
-
-    return await client.send_document(
-        chat_id, 
-        file_path, 
-        caption=caption, 
-        progress=progress_callback,
-        **kwargs
+            # Fall back to the next kind, reusing the uploaded parts
+            logging.warning(f"Failed to send {file_name} as {type(media).__name__}, falling back: {e}")
+    return await send_uploaded_media(client, chat_id, input_file, candidates[-1], read_part, caption=caption)
+
+async def upload_file_fast(client: Client, file_path, progress_callback=None):
+    """Uploads a local file with the smart upload settings. Returns (input_file, read_part)."""
+    file_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+    dc_id = await client.storage.dc_id()
+    workers, chunk_size = tuner.settings(dc_id, "upload", file_size)
+    
+    # Logging to verify smart logic is working
+    logging.info(f"Smart Upload: File={file_path}, Size={file_size}, Workers={workers}, Chunk={chunk_size}")
+    
+    start = time.time()
+    stats = TransferStats()
+    try:
+        input_file = await parallel_upload(client, file_path, workers, chunk_size, progress_callback=progress_callback, stats=stats)
+    finally:
+        tuner.record(dc_id, "upload", workers, chunk_size, stats)
+    logging.info(f"Parallel Upload: {file_path} done in {time.time() - start:.1f}s")
+    
+    async def read_part(part):
+        with open(file_path, "rb") as fp:
+            fp.seek(part * chunk_size)
+            return fp.read(chunk_size)
+    
+    return input_file, read_part
+
+async def upload_media_fast(client: Client, chat_id, file_path, caption="", progress_callback=None, **kwargs):
+    """Fast media uploader using smart upload-specific worker logic"""
+    input_file, read_part = await upload_file_fast(client, file_path, progress_callback)
+    return await send_input_file(
+        client, chat_id, input_file, os.path.basename(file_path), read_part,
+        caption=caption, **kwargs
+    )
+
+def input_media_from_uploaded(media):
+    """Turns the MessageMedia returned by messages.UploadMedia into an InputMedia that can be sent"""
+    if isinstance(media, types.MessageMediaPhoto):
+        return types.InputMediaPhoto(id=types.InputPhoto(
+            id=media.photo.id, access_hash=media.photo.access_hash, file_reference=media.photo.file_reference
+        ))
+    return types.InputMediaDocument(id=types.InputDocument(
+        id=media.document.id, access_hash=media.document.access_hash, file_reference=media.document.file_reference
+    ))
+
+def input_media_from_file_id(file_id):
+    """InputMedia for a file we already sent once (e.g. a media_cache entry)"""
+    decoded = FileId.decode(file_id)
+    if decoded.file_type == FileType.PHOTO:
+        return types.InputMediaPhoto(id=types.InputPhoto(
+            id=decoded.media_id, access_hash=decoded.access_hash, file_reference=decoded.file_reference
+        ))
+    return types.InputMediaDocument(id=types.InputDocument(
+        id=decoded.media_id, access_hash=decoded.access_hash, file_reference=decoded.file_reference
+    ))
+
+async def upload_album_media(client: Client, chat_id, file_path, progress_callback=None, **kwargs):
+    """
+    Uploads a file for an album: the parts go up in parallel, then messages.UploadMedia
+    registers the file without sending it. Returns an InputMedia for send_album().
+    """
+    input_file, read_part = await upload_file_fast(client, file_path, progress_callback)
+    candidates = await uploaded_media_candidates(client, input_file, os.path.basename(file_path), **kwargs)
+    peer = await client.resolve_peer(chat_id)
+    for i, media in enumerate(candidates):
+        while True:
+            try:
+                r = await client.invoke(functions.messages.UploadMedia(peer=peer, media=media))
+            except FilePartMissing as e:
+                part = int(e.file_part)
+                await reupload_part(client, input_file, part, await read_part(part))
+            except Exception as e:
+                if i == len(candidates) - 1:
+                    raise
+                logging.warning(f"Failed to upload {file_path} as {type(media).__name__}, falling back: {e}")
+                break
+            else:
+                return input_media_from_uploaded(r)
+
+async def send_album(client: Client, chat_id, medias):
+    """
+    Sends (InputMedia, caption) pairs as albums with messages.SendMultiMedia, 10 items per
+    request (Telegram's album limit). If Telegram rejects a group (e.g. documents mixed with
+    photos), its items are sent one by one instead. Returns the sent Messages in order, with
+    None for items Telegram refused on their own (BadRequest, e.g. a stale file reference).
+    """
+    peer = await client.resolve_peer(chat_id)
+    sent = []
+    for start in range(0, len(medias), 10):
+        chunk = medias[start:start + 10]
+        if len(chunk) > 1:
+            multi_media = [
+                types.InputSingleMedia(
+                    media=media,
+                    random_id=client.rnd_id(),
+                    **await utils.parse_text_entities(client, caption or "", client.parse_mode, None)
+                )
+                for media, caption in chunk
+            ]
+            try:
+                r = await client.invoke(functions.messages.SendMultiMedia(peer=peer, multi_media=multi_media))
+                sent.extend(await utils.parse_messages(client, r))
+                continue
+            except FloodWait:
+                raise
+            except Exception as e:
+                logging.warning(f"Album send failed ({e}), sending {len(chunk)} items separately")
+        for media, caption in chunk:
+            try:
+                r = await client.invoke(
+                    functions.messages.SendMedia(
+                        peer=peer,
+                        media=media,
+                        random_id=client.rnd_id(),
+                        **await utils.parse_text_entities(client, caption or "", client.parse_mode, None)
+                    )
+                )
+            except BadRequest as e:
+                logging.warning(f"Album item rejected: {e}")
+                sent.append(None)
+                continue
+            sent.extend(await utils.parse_messages(client, r))
+    return sent
+
+def get_relay_file_name(message, media):
+    file_name = getattr(media, "file_name", None)
+    if file_name:
+        return file_name
+    if getattr(message, "voice", None):
+        ext = ".ogg"
+    elif getattr(message, "video", None):
+        ext = ".mp4"
+    else:
+        ext = mimetypes.guess_extension(getattr(media, "mime_type", None) or "") or ""
+    return f"{media.file_unique_id}{ext}"
+
+async def relay_media(client: Client, source_client: Client, message, chat_id, caption="", progress_callback=None, progress_args=(), **kwargs):
+    """
+    Streams the media of `message` from `source_client` to `chat_id` (sent by `client`)
+    without touching the disk. Downloaded parts go into a ring of RELAY_BUFFER_PARTS slots
+    that the upload workers drain as parts arrive, so memory stays at
+    RELAY_BUFFER_PARTS * chunk_size per job whatever the file size.
+    Raises CdnRedirect if the file can only be fetched from a CDN DC.
+    """
+    media = get_media(message)
+    file_size = media.file_size
+    file_id = FileId.decode(media.file_id)
+    upload_dc_id = await client.storage.dc_id()
+    download_workers, download_chunk = tuner.settings(file_id.dc_id, "download", file_size)
+    upload_workers, upload_chunk = tuner.settings(upload_dc_id, "upload", file_size)
+    # Parts are uploaded exactly as they were downloaded, so both sides share one part size
+    chunk_size = min(download_chunk, upload_chunk)
+    
+    logging.info(f"Smart Relay: Size={file_size}, Download Workers={download_workers}, Upload Workers={upload_workers}, Chunk={chunk_size}, Buffer={RELAY_BUFFER_PARTS}")
+    
+    location = get_file_location(file_id)
+    total_parts = math.ceil(file_size / chunk_size)
+    is_big = file_size > 10 * 1024 * 1024
+    upload_id = client.rnd_id()
+    
+    slots = asyncio.Semaphore(RELAY_BUFFER_PARTS)
+    ready = asyncio.Queue()
+    next_part = 0
+    done = 0
+    # Small files need an md5 over the parts in order, parts can finish out of order
+    md5_sum = None if is_big else hashlib.md5()
+    md5_next = 0
+    md5_pending = {}
+    download_stats = TransferStats()
+    upload_stats = TransferStats()
+
+    async def downloader(session):
+        nonlocal next_part, md5_next
+        while next_part < total_parts:
+            await slots.acquire()
+            if next_part >= total_parts:
+                slots.release()
+                return
+            part = next_part
+            next_part += 1
+            try:
+                data = await fetch_part(session, location, part * chunk_size, chunk_size, download_stats)
+                download_stats.bytes += len(data)
+            except BaseException:
+                slots.release()
+                raise
+            if md5_sum:
+                md5_pending[part] = data
+                while md5_next in md5_pending:
+                    md5_sum.update(md5_pending.pop(md5_next))
+                    md5_next += 1
+            ready.put_nowait((part, data))
+
+    async def uploader(session):
+        nonlocal done
+        while True:
+            item = await ready.get()
+            if item is None:
+                return
+            part, data = item
+            await save_part(session, upload_id, part, data, total_parts, is_big, upload_stats)
+            upload_stats.bytes += len(data)
+            slots.release()
+            done += len(data)
+            await report_progress(progress_callback, min(done, file_size), file_size, progress_args)
+
+    source_sessions = []
+    upload_sessions = []
+    start = time.time()
+    try:
+        source_sessions = await open_media_sessions(source_client, file_id.dc_id, min(download_workers, total_parts))
+        upload_sessions = await open_media_sessions(client, upload_dc_id, min(upload_workers, total_parts))
+        up_tasks = [asyncio.ensure_future(uploader(s)) for s in upload_sessions]
+        down_tasks = [asyncio.ensure_future(downloader(s)) for s in source_sessions]
+
+        async def finish_downloads():
+            await asyncio.gather(*down_tasks)
+            for _ in up_tasks:
+                ready.put_nowait(None)
+
+        await gather_or_cancel([asyncio.ensure_future(finish_downloads()), *up_tasks, *down_tasks])
+    finally:
+        await close_media_sessions(source_sessions)
+        await close_media_sessions(upload_sessions)
+        tuner.record(file_id.dc_id, "download", download_workers, chunk_size, download_stats)
+        tuner.record(upload_dc_id, "upload", upload_workers, chunk_size, upload_stats)
+    
+    logging.info(f"Relay: {total_parts} parts relayed in {time.time() - start:.1f}s")
+    
+    name = get_relay_file_name(message, media)
+    if is_big:
+        input_file = types.InputFileBig(id=upload_id, parts=total_parts, name=name)
+    else:
+        input_file = types.InputFile(id=upload_id, parts=total_parts, name=name, md5_checksum=md5_sum.hexdigest())
+    
+    async def read_part(part):
+        # Nothing is kept on disk, so a part Telegram lost is fetched again from the source
+        session = await source_client.get_session(file_id.dc_id, is_media=True)
+        return await fetch_part(session, location, part * chunk_size, chunk_size)
+    
+    return await send_input_file(
+        client, chat_id, input_file, name, read_part,
+        caption=caption, mime_type=getattr(media, "mime_type", None), **kwargs
     )
@@ -0,0 +1,112 @@
+from datetime import datetime
+from bot.config import FREE_DAILY_LIMIT
+from bot.database import get_user, save_user_counters, reserve_quota, release_quota
+
+class UserContext:
+    """
+    The user as one request sees it: the users row is loaded once and the quota and ad state
+    are worked out from it, so the handler pipeline (quota check, ad, download) doesn't read
+    the row again at every step. Counter changes accumulate here and are written back in one
+    statement by save(); several tasks may share a context (e.g. the items of a batch).
+    Downloads are the exception: they are reserved in the database right away (reserve_quota)
+    so concurrent requests can't spend the same quota twice.
+    """
+    __slots__ = ("user_id", "user", "today", "ads", "premium_expired")
+
+    def __init__(self, user_id, user):
+        self.user_id = user_id
+        self.user = user
+        self.today = datetime.utcnow().date().isoformat()
+        # Not written back yet
+        self.ads = 0
+        self.premium_expired = False
+
+    @classmethod
+    async def load(cls, user_id):
+        return cls(user_id, await get_user(user_id))
+
+    @property
+    def exists(self):
+        return self.user is not None
+
+    @property
+    def role(self):
+        if not self.user:
+            return None
+        if self.premium_expired:
+            return "free"
+        return self.user.get("role")
+
+    @property
+    def is_premium(self):
+        return self.role in ["premium", "admin", "owner"]
+
+    @property
+    def session_string(self):
+        session_str = self.user.get("phone_session_string") if self.user else None
+        return session_str if session_str and len(session_str) > 10 else None
+
+    @property
+    def downloads_today(self):
+        done = self.user.get("downloads_today", 0) if self.user and self.user.get("last_download_date") == self.today else 0
+        return done or 0
+
+    @property
+    def ads_today(self):
+        shown = self.user.get("ads_today", 0) if self.user and self.user.get("last_ad_date") == self.today else 0
+        return (shown or 0) + self.ads
+
+    def check_quota(self):
+        """Whether the user may download now: (allowed, message)"""
+        if not self.user:
+            return False, "User not found."
+        if self.user.get("is_banned"):
+            return False, "You are banned from using this bot."
+
+        expiry = self.user.get("premium_expiry_date")
+        if self.user.get("role") == "premium" and expiry and expiry < self.today:
+            self.premium_expired = True
+
+        if self.is_premium:
+            return True, "Unlimited"
+        if self.downloads_today >= FREE_DAILY_LIMIT:
+            return False, f"Daily limit reached ({FREE_DAILY_LIMIT}/{FREE_DAILY_LIMIT}). Upgrade to Premium for unlimited downloads."
+        return True, f"{self.downloads_today}/{FREE_DAILY_LIMIT}"
+
+    async def _reload(self):
+        # The quota functions refresh the cached row, so this is a memory read
+        user = await get_user(self.user_id)
+        if user:
+            self.user = user
+
+    async def reserve_quota(self, count):
+        """Reserves up to `count` downloads. Returns (granted, is_unlimited)."""
+        if not self.user:
+            return 0, False
+        granted, unlimited = await reserve_quota(self.user_id, count)
+        await self._reload()
+        return granted, unlimited
+
+    async def release_quota(self, count):
+        """Gives back reserved downloads that weren't delivered"""
+        if count > 0:
+            await release_quota(self.user_id, count)
+            await self._reload()
+
+    def add_ad(self):
+        self.ads += 1
+
+    async def save(self):
+        """Writes the pending counter changes (if any) back to the users row"""
+        if not self.user or not (self.ads or self.premium_expired):
+            return
+        ads, expire = self.ads, self.premium_expired
+        # Fold the pending changes into the row so later reads through this context stay right
+        self.user["ads_today"] = self.ads_today
+        self.user["last_ad_date"] = self.today
+        if expire:
+            self.user["role"] = "free"
+            self.user["premium_expiry_date"] = None
+        self.ads = 0
+        self.premium_expired = False
+        await save_user_counters(self.user_id, ads=ads, expire_premium=expire)
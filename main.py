@@ -38,6 +38,14 @@ if __name__ == "__main__":
     print("Initializing database...")
     init_db()
 
+    # Bring back the bot's auth key when the session file was lost with the old disk
+    from bot.session_store import restore_bot_session, persist_bot_session
+    asyncio.get_event_loop().run_until_complete(restore_bot_session(app))
+
+    # Jobs a restart cut off go back to the queue (before any new job can start)
+    from bot.database import requeue_interrupted_jobs
+    asyncio.get_event_loop().run_until_complete(requeue_interrupted_jobs())
+
     # Check for TgCrypto and debug crypto speed
     try:
         import tgcrypto
@@ -47,6 +55,15 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"❌ TgCrypto Debug Error: {e}")
 
+    # Measure AES-IGE speed so the transfer tuner never runs more workers than the CPU can encrypt
+    from bot.autotune import tuner, benchmark_crypto
+    try:
+        tuner.crypto_speed = benchmark_crypto()
+        print(f"🔐 AES-IGE speed: {tuner.crypto_speed / 1024 / 1024:.1f} MB/s")
+    except Exception as e:
+        print(f"❌ Crypto benchmark failed: {e}")
+    asyncio.get_event_loop().run_until_complete(tuner.load())
+
     print("Starting cleanup task...")
     from bot.login import cleanup_expired_logins
     from bot.web import start_health_check
@@ -59,8 +76,22 @@ if __name__ == "__main__":
     from bot.logger import cleanup_loop
     asyncio.get_event_loop().create_task(cleanup_loop())
     asyncio.get_event_loop().create_task(periodic_cloud_backup(interval_minutes=10))
+    from bot.transfer import partial_cleanup_loop
+    asyncio.get_event_loop().create_task(partial_cleanup_loop(app))
+    from bot.client_pool import user_client_pool
+    asyncio.get_event_loop().create_task(user_client_pool.idle_reaper())
+    asyncio.get_event_loop().create_task(persist_bot_session(app))
+    from bot.jobs import job_worker_loop
+    asyncio.get_event_loop().create_task(job_worker_loop(app))
+    from bot.database import counter_flush_loop
+    asyncio.get_event_loop().create_task(counter_flush_loop())
     print("Starting bot...")
     if app:
         app.run()
+        # Running downloads are cut off here and resume from their jobs rows after the restart
+        from bot.task_registry import running_tasks
+        asyncio.get_event_loop().run_until_complete(running_tasks.shutdown())
+        from bot.database import close_db
+        close_db()
     else:
         print("Bot app not initialized due to missing config. Exiting.")
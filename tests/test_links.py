@@ -0,0 +1,60 @@
+import os
+import re
+import timeit
+
+import pytest
+
+from bot.links import ParsedLink, parse_link
+
+CASES = [
+    ("https://t.me/durov/123", ParsedLink("public", "durov", 123, False)),
+    ("t.me/durov/123", ParsedLink("public", "durov", 123, False)),
+    ("https://t.me/c/1234567/89", ParsedLink("private", "1234567", 89, True)),
+    ("https://t.me/c/1234567/5/89", ParsedLink("topic", "1234567", 89, True, thread_id=5)),
+    ("https://t.me/some_group/5/89", ParsedLink("topic", "some_group", 89, False, thread_id=5)),
+    ("https://t.me/durov/10?comment=42", ParsedLink("comment", "durov", 42, False, thread_id=10)),
+    ("https://t.me/c/1234567/10?comment=42", ParsedLink("comment", "1234567", 42, True, thread_id=10)),
+    ("https://t.me/durov/s/7", ParsedLink("story", "durov", 7, False)),
+    ("https://t.me/c/1234567/s/7", ParsedLink("story", "1234567", 7, True)),
+    ("https://t.me/durov/123?single", ParsedLink("single", "durov", 123, False)),
+    ("https://t.me/c/1234567/89?single", ParsedLink("single", "1234567", 89, True)),
+    ("https://t.me/c/1234567/5/89?single", ParsedLink("single", "1234567", 89, True, thread_id=5)),
+    ("https://t.me/durov/123?thread=100", ParsedLink("thread", "durov", 123, False, thread_id=100)),
+    ("https://t.me/c/1234567/89?thread=100", ParsedLink("thread", "1234567", 89, True, thread_id=100)),
+    ("https://t.me/durov/123?single&comment=5", ParsedLink("comment", "durov", 5, False, thread_id=123)),
+    ("check this https://t.me/durov/123 out", ParsedLink("public", "durov", 123, False)),
+    ("https://t.me/cats/12", ParsedLink("public", "cats", 12, False)),
+    # A private link without the post id is malformed, not a public chat called "c"
+    ("https://t.me/c/55", None),
+    ("https://t.me/durov", None),
+    ("https://t.me/+AbCdEf123", None),
+    ("hello", None),
+    ("", None),
+]
+
+# The eleven separate searches run_download used before parse_link
+LEGACY_PATTERNS = [
+    r"t\.me/([^/]+)/(\d+)", r"t\.me/c/(\d+)/(\d+)", r"t\.me/c/(\d+)/(\d+)/(\d+)",
+    r"t\.me/([^/]+)/(\d+)\?comment=(\d+)", r"t\.me/c/(\d+)/(\d+)\?comment=(\d+)",
+    r"t\.me/([^/]+)/s/(\d+)", r"t\.me/c/(\d+)/s/(\d+)", r"t\.me/([^/]+)/(\d+)\?single",
+    r"t\.me/c/(\d+)/(\d+)\?single", r"t\.me/([^/]+)/(\d+)\?thread=(\d+)",
+    r"t\.me/c/(\d+)/(\d+)\?thread=(\d+)",
+]
+
+@pytest.mark.parametrize("text, expected", CASES)
+def test_parse_link(text, expected):
+    assert parse_link(text) == expected
+
+def test_private_chat_id():
+    assert parse_link("https://t.me/c/1234567/89").chat_id == -1001234567
+    assert parse_link("https://t.me/durov/123").chat_id == "durov"
+
+@pytest.mark.skipif(not os.environ.get("RUN_BENCHMARKS"), reason="benchmark: set RUN_BENCHMARKS=1 and run with -s")
+def test_benchmark_parse_link():
+    # Reports timings only; wall-clock comparisons make no reliable assertion
+    links = [text for text, _ in CASES]
+    runs = 2000
+    new = timeit.timeit(lambda: [parse_link(text) for text in links], number=runs)
+    old = timeit.timeit(lambda: [[re.search(p, text) for p in LEGACY_PATTERNS] for text in links], number=runs)
+    per_link = runs * len(links)
+    print(f"\nparse_link: {new / per_link * 1e6:.2f} us/link, legacy searches: {old / per_link * 1e6:.2f} us/link ({old / new:.1f}x)")